@@ -1,5 +1,9 @@
 # given trip based NIS probability aggregate for port
 # High-order risk (not finished)
+# 1 - prod(1 - risk) is computed as 1 - exp(sum log(1 - risk)), trips without a risk
+# count as 0; the per port aggregates are roll-ups of a RiskCube (risk_cube.py) saved
+# next to the trip output, so a later AggregateRisk of the same output reads no trips
+# the port reference data (PortParser) is only loaded for the realm aggregates
 
 
 from pathlib import Path
@@ -7,37 +11,29 @@ import typing as tp
 import pandas as pd
 import numpy as np
 
-from parsers import PortParser
+from parsers import (
+    PortParser,
+    TRIP_FILE_COLUMNS,
+    TRIP_RISK_COLUMNS,
+    TRIP_SCHEMA,
+    read_pipe_file,
+)
+from risk_cube import RiskCube, risk_trips, trip_signature
+from survival import log_survival
 
 DATA_DIR = Path(__file__).parent.joinpath("data")
 
 # default record output
 TRIP_RECORD_DIR = DATA_DIR.joinpath("trip_record.txt")
 
-trip_file_columns = [
-    "o_port",
-    "o_port_id",
-    "o_port_lat",
-    "o_port_lon",
-    "o_port_country",
-    "d_port",
-    "d_port_id",
-    "d_port_lat",
-    "d_port_lon",
-    "d_port_country",
-    "vessel_id",
-    "vessel_imo",
-    "vessel_type",
-    "vessel_dwt",
-    "arrival_date",
-    "departure_date",
-    "distance",
-    "spd",
-    "voyage_duration",
-    "stay_duration",
-    "ballast_risk",
-    "biofouling_risk",
-]
+trip_file_columns = TRIP_FILE_COLUMNS
+
+# origin grouping of aggregate_all_ports
+ORIGIN_GROUPS = {
+    "country": "o_port_country",
+    "realm": "o_port_realm",
+    "vessel_type": "vessel_type",
+}
 
 
 class AggregateRisk:
@@ -45,117 +41,129 @@ class AggregateRisk:
         self,
         trip_file_address: str = TRIP_RECORD_DIR,
         record_file: tp.Optional[pd.DataFrame] = None,
+        columns: tp.Optional[tp.Sequence[str]] = None,
+        d_port_ids: tp.Optional[tp.Sequence[int]] = None,
+        port_parser: tp.Optional[PortParser] = None,
     ):
-        if record_file is not None:
-            self.record = record_file
-        else:
-            with open(trip_file_address, "r") as f:
-                file = f.readlines()
-            file = [line.strip().split("|") for line in file]
-            file = pd.DataFrame(file, columns=trip_file_columns)
-            file["ballast_risk"] = file["ballast_risk"].astype(float)
-            file["biofouling_risk"] = file["biofouling_risk"].astype(float)
-            file = file[
-                ((file["ballast_risk"] != 0.0) | (file["biofouling_risk"] != 0.0))
-                & ((~file["ballast_risk"].isna()) | (~file["biofouling_risk"].isna()))
-            ]
-            file.reset_index(drop=True, inplace=True)
-
-            self.record = file
+        # trip_file_address: trip text file or parquet store (process_origin_trips --format parquet)
+        # a parquet store only reads columns (+ risk columns) of the d_port_ids trips
+        # trips are read on first use of record; the cube of a whole trip output is saved
+        # port_parser resolves the realms, PortParser() of the default files otherwise
+        self.trip_file_address = trip_file_address
+        self.columns = columns
+        self.d_port_ids = d_port_ids
+        self._record = record_file
+        # the cube of a whole trip output is saved and loaded next to it
+        self._whole_output = record_file is None and columns is None and d_port_ids is None
+        self._port_parser = port_parser
+        self._cube = None
+        self._port_dicts = {}
+        self._realm_set = None
+
+    @property
+    def record(self) -> pd.DataFrame:
+        if self._record is None:
+            if Path(self.trip_file_address).is_dir():
+                from trip_store import read_trip_parquet
+
+                columns = self.columns
+                if columns is not None:
+                    columns = list(dict.fromkeys(list(columns) + TRIP_RISK_COLUMNS))
+                file = read_trip_parquet(
+                    self.trip_file_address, columns, d_port_ids=self.d_port_ids
+                )
+            else:
+                file = read_pipe_file(self.trip_file_address, TRIP_SCHEMA, header=False)
+            file = risk_trips(file).reset_index(drop=True)
+
+            self._record = file
+        return self._record
+
+    @property
+    def port_parser(self) -> PortParser:
+        # built on first use and shared by every aggregate_by_realm call
+        if self._port_parser is None:
+            self._port_parser = PortParser()
+        return self._port_parser
+
+    @property
+    def cube(self) -> RiskCube:
+        # saved cube of the whole trip output, built (and saved) from record otherwise
+        if self._cube is None:
+            if self._whole_output:
+                self._cube = RiskCube.load(self.trip_file_address)
+            if self._cube is None:
+                signature = trip_signature(self.trip_file_address) if self._whole_output else None
+                self._cube = RiskCube.from_trips(self.record, signature=signature)
+                if self._whole_output:
+                    self._cube.save(self.trip_file_address)
+        return self._cube
+
+    def aggregate_all_ports(self, by: tp.Optional[str] = None) -> pd.DataFrame:
+        # agg ballast/biofouling risk of every desti_port, by None or an ORIGIN_GROUPS key
+        # (one row per desti_port x origin country / realm / vessel type)
+        # ballast_trips / biofouling_trips count the trips with a non zero risk
+        if by is not None and by not in ORIGIN_GROUPS:
+            raise ValueError(f"unknown origin grouping {by}")
+        if by == "realm" and self.cube.add_realm(self.port_parser) and self._whole_output:
+            self.cube.save(self.trip_file_address)
+        return self.cube.rollup(["d_port"] + ([ORIGIN_GROUPS[by]] if by is not None else []))
+
+    def _port_aggregates(
+        self, by: tp.Optional[str], port_name: tp.Optional[str]
+    ) -> tp.Tuple[tp.Dict, ...]:
+        # ballast / biofouling risk and trip count dicts of one desti_port by origin
+        # group (by None: of every desti_port), kept per (by, port_name)
+        if (by, port_name) not in self._port_dicts:
+            table = self.aggregate_all_ports(by)
+            if by is not None:
+                ports = table.index.get_level_values("d_port")
+                table = table[ports == port_name].droplevel("d_port")
+            self._port_dicts[(by, port_name)] = tuple(
+                table[column].to_dict()
+                for column in ["ballast_risk", "biofouling_risk", "ballast_trips", "biofouling_trips"]
+            )
+        return self._port_dicts[(by, port_name)]
 
     def aggregate_one_port(self, port_name: str) -> tp.List[float]:
         # given desti_port
         # return agg ballast/biofouling risk
-        F = self.record[self.record["d_port"] == port_name]
-        agg_ballast_risk = 1.0
-        agg_biofouling_risk = 1.0
-        agg_ballast_risk, agg_biofouling_risk = self.iter_and_multi(
-            F, agg_ballast_risk, agg_biofouling_risk
-        )
-        agg_ballast_risk = 1 - agg_ballast_risk
-        agg_biofouling_risk = 1 - agg_biofouling_risk
-        return agg_ballast_risk, agg_biofouling_risk
+        ballast, biofouling, _, _ = self._port_aggregates(None, None)
+        return ballast.get(port_name, 0.0), biofouling.get(port_name, 0.0)
 
     def aggregate_by_realm(
         self, port_name: str = "Singapore"
     ) -> tp.Tuple[tp.Dict[str, float]]:
         # given desti_port
         # output biofouling/ballast risk organized by 7 eco_realm
-        port_parser = PortParser()
-        realm_set = set(port_parser.meow_info["REALM"].values)
-        bio_risk_dict = {key: 1.0 for key in realm_set}
-        ballast_risk_dict = {key: 1.0 for key in realm_set}
-
-        F = self.record[
-            (self.record["d_port"] == port_name)
-            & (
-                (self.record["ballast_risk"] != 0.0)
-                | (self.record["biofouling_risk"] != 0.0)
-            )
-        ]
-        origin_port_list = list(set(F["o_port"].values))
-        for origin_port in origin_port_list:
-            Q = F[F["o_port"] == origin_port]
-            o_port_id = int(Q.iloc[0]["o_port_id"])
-            o_port_realm = port_parser.check_meow_region(o_port_id)
-            _bio_risk = bio_risk_dict[o_port_realm]
-            _ballast_risk = ballast_risk_dict[o_port_realm]
-            _ballast_risk, _bio_risk = self.iter_and_multi(Q, _ballast_risk, _bio_risk)
-            bio_risk_dict[o_port_realm] = _bio_risk
-            ballast_risk_dict[o_port_realm] = _ballast_risk
-        
-        for key in bio_risk_dict:
-            bio_risk_dict[key] = 1.0 - bio_risk_dict[key]
-        for key in ballast_risk_dict:
-            ballast_risk_dict[key] = 1.0 - ballast_risk_dict[key]
+        if self._realm_set is None:
+            self._realm_set = set(self.port_parser.meow_table["REALM"].values)
+        realm_set = self._realm_set
+        ballast_risk_dict = {key: 0.0 for key in realm_set}
+        bio_risk_dict = {key: 0.0 for key in realm_set}
+        ballast, biofouling, _, _ = self._port_aggregates("realm", port_name)
+        ballast_risk_dict.update(ballast)
+        bio_risk_dict.update(biofouling)
         return ballast_risk_dict, bio_risk_dict,
 
     def aggregate_by_country(self, port_name: str='Singapore') -> tp.Tuple[tp.Dict[str, float]]:
         # given desti_port
         # output biofouling/ballast risk organized by origin port country
-        
-        # agg ballast risk
-        F_ballast = self.record[
-            (self.record["d_port"] == port_name)
-            & 
-                (self.record["ballast_risk"] != 0.0)
-
-        ]   
-        origin_country_list = list(set(F_ballast["o_port_country"].values))
-        ballast_risk_dict = dict()
-        for origin_country in origin_country_list:
-            Q = F_ballast[F_ballast["o_port_country"] == origin_country]
-            _ballast_risk = 1.0
-            _bio_risk = 1.0
-            _ballast_risk, _ = self.iter_and_multi(Q, _ballast_risk, _bio_risk)
-            ballast_risk_dict[origin_country] = 1.0 - _ballast_risk
-            
-        # aggregate biofouling risk    
-        F_bio = self.record[
-            (self.record["d_port"] == port_name)
-            & 
-                (self.record["biofouling_risk"] != 0.0)
-
-        ]            
-        origin_country_list = list(set(F_bio["o_port_country"].values))
-        bio_risk_dict = dict()
-        for origin_country in origin_country_list:
-            Q = F_bio[F_bio['o_port_country'] == origin_country]
-            _ballast_risk = 1.0
-            _bio_risk = 1.0
-            _, _bio_risk = self.iter_and_multi(Q, _ballast_risk, _bio_risk)
-            bio_risk_dict[origin_country] = 1.0 - _bio_risk
+        # a country is listed when one of its trips has a non zero risk of that kind
+        ballast, biofouling, ballast_trips, bio_trips = self._port_aggregates(
+            "country", port_name
+        )
+        ballast_risk_dict = {key: ballast[key] for key in ballast if ballast_trips[key] > 0}
+        bio_risk_dict = {key: biofouling[key] for key in biofouling if bio_trips[key] > 0}
         return ballast_risk_dict, bio_risk_dict
-            
+
     @staticmethod
     def iter_and_multi(
         df: pd.DataFrame, agg_ballast_risk=1.0, agg_biofouling_risk=1.0
     ) -> tp.Tuple[float]:
-        for _, line in df.iterrows():
-            ba_r = line["ballast_risk"]
-            bio_r = line["biofouling_risk"]
-            if ~pd.isna(ba_r):
-                agg_ballast_risk *= (1 - ba_r)
-            if ~pd.isna(bio_r):
-                agg_biofouling_risk *= (1 - bio_r)
-        return agg_ballast_risk, agg_biofouling_risk
+        # agg_*_risk times prod(1 - risk) of the trips of df, missing risks are skipped
+        ballast, biofouling = (
+            np.exp(log_survival(df[risk].to_numpy(dtype=float, na_value=np.nan)).sum())
+            for risk in TRIP_RISK_COLUMNS
+        )
+        return agg_ballast_risk * ballast, agg_biofouling_risk * biofouling
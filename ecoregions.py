@@ -0,0 +1,252 @@
+# ecoregion assignment of ports from their position
+# MEOW / FEOW polygons, batched spatial join over the geopandas spatial index,
+# then nearest polygon border (haversine) for ports just outside every polygon
+# used by PortParser for ports without a row / a region in the env file
+import typing as tp
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from scipy.spatial import cKDTree
+
+# region name column of the FEOW shapefile
+FEOW_REGION_COLUMN = "ECOREGION"
+# env file values filled from the ports of the same ecoregion
+ENV_VALUE_COLUMNS = ["MIN_T", "MAX_T", "RANGE_T", "YR_MEAN_T", "Salinity"]
+
+EARTH_RADIUS_KM = 6371.0
+# ports further than this from every ecoregion border stay without a region
+NEAREST_ECOREGION_MAX_KM = 100.0
+# polygon borders are densified to vertices at most this far apart (deg)
+BORDER_SEGMENT_DEG = 0.1
+
+
+def assign_ecoregions(
+    port_lat: tp.Sequence[float],
+    port_lon: tp.Sequence[float],
+    shapefile_dir: str,
+    columns: tp.Sequence[str] = ("ECOREGION",),
+    index: tp.Optional[pd.Index] = None,
+) -> pd.DataFrame:
+    # polygon attributes (columns) of every point, missing when no polygon contains it
+    # one sjoin for all points, points on a shared border keep the first polygon
+    regions = gpd.read_file(shapefile_dir)[list(columns) + ["geometry"]]
+    points = gpd.GeoDataFrame(
+        index=index,
+        geometry=gpd.points_from_xy(port_lon, port_lat),
+        crs="EPSG:4326",
+    )
+    if regions.crs is not None:
+        regions = regions.to_crs(points.crs)
+    joined = gpd.sjoin(points, regions, how="left", predicate="intersects")
+    joined = joined[~joined.index.duplicated(keep="first")]
+    return pd.DataFrame(joined[list(columns)])
+
+
+class EcoregionIndex:
+    # nearest ecoregion of a point by great circle distance to the polygon borders
+    # KD-tree over unit sphere vectors of the border vertices: chord length grows
+    # with haversine distance, so the nearest chord is the nearest vertex on earth
+    def __init__(
+        self,
+        shapefile_dir: str,
+        columns: tp.Sequence[str] = ("ECOREGION",),
+        segment_deg: float = BORDER_SEGMENT_DEG,
+    ) -> None:
+        regions = gpd.read_file(shapefile_dir)
+        if regions.crs is not None:
+            regions = regions.to_crs("EPSG:4326")
+        self.attributes = pd.DataFrame(regions[list(columns)]).reset_index(drop=True)
+        border = shapely.segmentize(regions.geometry.boundary.values, segment_deg)
+        coords, self._owner = shapely.get_coordinates(border, return_index=True)
+        self._tree = cKDTree(_unit_vectors(coords[:, 1], coords[:, 0]))
+
+    def nearest(
+        self,
+        port_lat: tp.Sequence[float],
+        port_lon: tp.Sequence[float],
+        max_km: float = NEAREST_ECOREGION_MAX_KM,
+        index: tp.Optional[pd.Index] = None,
+    ) -> pd.DataFrame:
+        # attributes of the nearest region and its distance (km), one batched query
+        # missing when nothing lies within max_km
+        max_chord = 2 * np.sin(min(max_km / EARTH_RADIUS_KM, np.pi) / 2)
+        chord, vertex = self._tree.query(
+            _unit_vectors(port_lat, port_lon), distance_upper_bound=max_chord
+        )
+        found = np.isfinite(chord)
+        owner = np.full(len(chord), -1)
+        owner[found] = self._owner[vertex[found]]
+        nearest = self.attributes.reindex(owner)
+        nearest["distance_km"] = np.where(
+            found, 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(chord, 2.0) / 2), np.nan
+        )
+        nearest.index = index if index is not None else pd.RangeIndex(len(chord))
+        return nearest
+
+
+def _unit_vectors(lat, lon) -> np.ndarray:
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lon = np.radians(np.asarray(lon, dtype=float))
+    return np.column_stack(
+        [np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)]
+    )
+
+
+def assign_regions(
+    port_lat: np.ndarray,
+    port_lon: np.ndarray,
+    index: pd.Index,
+    meow_dir: str,
+    feow_dir: tp.Optional[str] = None,
+    max_km: float = NEAREST_ECOREGION_MAX_KM,
+) -> pd.DataFrame:
+    # MEOW_region / MEOW_province / FEOW_region of every point, in order:
+    # MEOW polygon, FEOW polygon, nearest MEOW border, nearest FEOW border
+    has_feow = feow_dir is not None and Path(feow_dir).exists()
+    regions = pd.DataFrame(
+        {"MEOW_region": np.nan, "MEOW_province": np.nan, "FEOW_region": np.nan},
+        index=index,
+        dtype=object,
+    )
+    meow = assign_ecoregions(port_lat, port_lon, meow_dir, ("ECOREGION", "PROVINCE"), index)
+    regions["MEOW_region"] = meow["ECOREGION"]
+    regions["MEOW_province"] = meow["PROVINCE"]
+
+    def todo() -> np.ndarray:
+        return (regions["MEOW_region"].isna() & regions["FEOW_region"].isna()).to_numpy()
+
+    if has_feow and todo().any():
+        left = todo()
+        feow = assign_ecoregions(
+            port_lat[left], port_lon[left], feow_dir, (FEOW_REGION_COLUMN,), index[left]
+        )
+        regions.loc[feow.index, "FEOW_region"] = feow[FEOW_REGION_COLUMN]
+    if todo().any():
+        left = todo()
+        nearest = EcoregionIndex(meow_dir, ("ECOREGION", "PROVINCE")).nearest(
+            port_lat[left], port_lon[left], max_km, index[left]
+        )
+        regions.loc[nearest.index, "MEOW_region"] = nearest["ECOREGION"]
+        regions.loc[nearest.index, "MEOW_province"] = nearest["PROVINCE"]
+    if has_feow and todo().any():
+        left = todo()
+        nearest = EcoregionIndex(feow_dir, (FEOW_REGION_COLUMN,)).nearest(
+            port_lat[left], port_lon[left], max_km, index[left]
+        )
+        regions.loc[nearest.index, "FEOW_region"] = nearest[FEOW_REGION_COLUMN]
+    return regions
+
+
+def _place_positions(places: pd.DataFrame) -> pd.DataFrame:
+    # unique places with a position, indexed by PLACE ID
+    places = places.drop_duplicates("PLACE ID", keep=False)
+    positions = pd.DataFrame(
+        {
+            "NAME": places["PLACE NAME"].to_numpy(),
+            "lat": places["LATITUDE DECIMAL"].astype(float).to_numpy(),
+            "lon": places["LONGITUDE DECIMAL"].astype(float).to_numpy(),
+        },
+        index=pd.Index(places["PLACE ID"].to_numpy(), name="ID"),
+    )
+    return positions.dropna(subset=["lat", "lon"])
+
+
+def env_from_ecoregions(
+    places: pd.DataFrame,
+    env_file: pd.DataFrame,
+    meow_dir: str,
+    feow_dir: tp.Optional[str] = None,
+) -> pd.DataFrame:
+    # env file rows (same columns) for places missing from it
+    # temperature / salinity from the mean of the env file ports in the region
+    # (province when none)
+    positions = _place_positions(places)
+    index = positions.index
+    rows = pd.DataFrame({"ID": index, "NAME": positions["NAME"]}, index=index)
+    regions = assign_regions(
+        positions["lat"].to_numpy(), positions["lon"].to_numpy(), index, meow_dir, feow_dir
+    )
+    rows = rows.join(regions)
+    rows = rows[rows["MEOW_region"].notna() | rows["FEOW_region"].notna()]
+    return fill_env_values(rows, env_file)
+
+
+def fill_missing_regions(
+    env_file: pd.DataFrame,
+    places: pd.DataFrame,
+    meow_dir: str,
+    feow_dir: tp.Optional[str] = None,
+) -> pd.DataFrame:
+    # env file with MEOW / FEOW region (and neighbours) filled from the port position
+    # for rows that have neither
+    missing = env_file["MEOW_region"].isna()
+    if "FEOW_region" in env_file:
+        missing &= env_file["FEOW_region"].isna()
+    positions = _place_positions(places)
+    positions = positions[positions.index.isin(env_file.loc[missing, "ID"])]
+    if len(positions) == 0:
+        return env_file
+    regions = assign_regions(
+        positions["lat"].to_numpy(),
+        positions["lon"].to_numpy(),
+        positions.index,
+        meow_dir,
+        feow_dir,
+    )
+    regions = regions[regions["MEOW_region"].notna() | regions["FEOW_region"].notna()]
+    env_file = env_file.copy()
+    fill = missing & env_file["ID"].isin(regions.index)
+    ids = env_file.loc[fill, "ID"]
+    for column in ["MEOW_region", "MEOW_province", "FEOW_region"]:
+        if column in env_file:
+            env_file[column] = env_file[column].astype(object)
+            env_file.loc[fill, column] = regions.loc[ids, column].to_numpy()
+    neighbours = _region_neighbours(env_file.loc[fill], env_file[~missing])
+    for column in neighbours:
+        env_file[column] = env_file[column].astype(object)
+        env_file.loc[fill, column] = neighbours[column].to_numpy()
+    return env_file
+
+
+def fill_env_values(rows: pd.DataFrame, env_file: pd.DataFrame) -> pd.DataFrame:
+    # env values / neighbours of rows that only know their ecoregion, rows whose
+    # region and province have no env file port are dropped
+    rows = rows.copy()
+    for column in ENV_VALUE_COLUMNS:
+        rows[column] = np.nan
+    rows["Temp_Src"] = ""
+    for key in ["MEOW_region", "MEOW_province", "FEOW_region"]:
+        if key not in env_file:
+            continue
+        means = env_file.groupby(key)[ENV_VALUE_COLUMNS].mean()
+        todo = rows["YR_MEAN_T"].isna() & rows[key].isin(means.index)
+        if todo.any():
+            rows.loc[todo, ENV_VALUE_COLUMNS] = means.loc[
+                rows.loc[todo, key], ENV_VALUE_COLUMNS
+            ].to_numpy()
+            rows.loc[todo, "Temp_Src"] = f"{key} mean"
+    rows["Sal_Src"] = rows["Temp_Src"]
+    # rows no region / province mean reached stay unresolved (error line when scored)
+    rows = rows.dropna(subset=["YR_MEAN_T", "Salinity"])
+    for column, values in _region_neighbours(rows, env_file).items():
+        rows[column] = values.to_numpy()
+    return rows[[c for c in env_file.columns if c in rows]].reset_index(drop=True)
+
+
+def _region_neighbours(rows: pd.DataFrame, env_file: pd.DataFrame) -> pd.DataFrame:
+    # MEOW_Neighbors / FEOW_Neighbors of rows, taken from an env file row of the same region
+    neighbours = pd.DataFrame(index=rows.index)
+    for region, neighbour in [
+        ("MEOW_region", "MEOW_Neighbors"),
+        ("FEOW_region", "FEOW_Neighbors"),
+    ]:
+        if neighbour not in env_file or region not in rows:
+            continue
+        known = env_file.dropna(subset=[region, neighbour]).drop_duplicates(region)
+        neighbours[neighbour] = (
+            rows[region].map(known.set_index(region)[neighbour]).fillna("NA")
+        )
+    return neighbours
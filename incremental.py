@@ -0,0 +1,381 @@
+# incremental refresh of a scored trip file after a new drop of its record file
+# the manifest keeps, per record row: a key (VESSEL ID, PLACE ID, ARRIVAL DATE and the
+# occurrence of that triple), a hash of the row content and where its trip / error line
+# sits in the outputs. A refresh hashes the new file, scores only new or changed rows
+# and rebuilds both outputs in row order, unchanged rows are copied from the old
+# outputs as byte blocks, delta rows are scored on the --workers pool like a full run.
+# The destination ports whose trips changed are listed in <output>.delta.json and the
+# cells of those ports are rebuilt in the saved RiskCube of the old output (the rest
+# of the cube is kept), from their trip lines found through the manifest d_port_id
+# the manifest also keeps the port / vessel files and NIS parameters the outputs were
+# scored with, a change in any of them rescores every row
+import io
+import json
+import mmap
+import os
+import typing as tp
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from parsers import (
+    RECORD_CHUNK_SIZE,
+    TRIP_SCHEMA,
+    RecordParser,
+    _file_signature,
+    read_pipe_file,
+)
+from risk_cube import RiskCube, risk_trips, trip_signature
+
+# record columns identifying a port call
+IDENTITY_COLUMNS = ["VESSEL ID", "PLACE ID", "ARRIVAL DATE"]
+MANIFEST_VERSION = 3
+# d_port_id field of a trip line
+D_PORT_ID_FIELD = 6
+
+
+class TripManifest:
+    # per-row arrays in record row order, offsets / lengths in bytes
+    # rows without a trip (error) line have length 0 at the position it would have
+    # and d_port_id -1
+    def __init__(
+        self,
+        keys: np.ndarray,
+        hashes: np.ndarray,
+        trip_offset: tp.Optional[np.ndarray] = None,
+        trip_length: tp.Optional[np.ndarray] = None,
+        error_offset: tp.Optional[np.ndarray] = None,
+        error_length: tp.Optional[np.ndarray] = None,
+        d_port_id: tp.Optional[np.ndarray] = None,
+    ) -> None:
+        self.keys = keys
+        self.hashes = hashes
+        zeros = lambda: np.zeros(len(keys), dtype=np.int64)
+        self.trip_offset = trip_offset if trip_offset is not None else zeros()
+        self.trip_length = trip_length if trip_length is not None else zeros()
+        self.error_offset = error_offset if error_offset is not None else zeros()
+        self.error_length = error_length if error_length is not None else zeros()
+        self.d_port_id = d_port_id if d_port_id is not None else zeros() - 1
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @staticmethod
+    def manifest_dir(output_dir: str) -> Path:
+        return Path(f"{output_dir}.manifest.npz")
+
+    @classmethod
+    def load(
+        cls, output_dir: str, error_dir: str, inputs: str
+    ) -> tp.Optional["TripManifest"]:
+        # manifest of the current outputs, None when missing, the outputs moved on or
+        # they were scored from other inputs (input_signature)
+        try:
+            with np.load(cls.manifest_dir(output_dir)) as saved:
+                if (
+                    int(saved["version"]) != MANIFEST_VERSION
+                    or list(saved["signature"]) != _output_signature(output_dir, error_dir)
+                    or str(saved["inputs"]) != inputs
+                ):
+                    return None
+                return cls(
+                    saved["keys"],
+                    saved["hashes"],
+                    saved["trip_offset"],
+                    saved["trip_length"],
+                    saved["error_offset"],
+                    saved["error_length"],
+                    saved["d_port_id"],
+                )
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def save(self, output_dir: str, error_dir: str, inputs: str) -> None:
+        manifest_dir = self.manifest_dir(output_dir)
+        temp_file = manifest_dir.with_name(f"{manifest_dir.name}.tmp")
+        with open(temp_file, "wb") as f:
+            np.savez(
+                f,
+                version=np.array(MANIFEST_VERSION),
+                signature=np.array(_output_signature(output_dir, error_dir)),
+                inputs=np.array(inputs),
+                keys=self.keys,
+                hashes=self.hashes,
+                trip_offset=self.trip_offset,
+                trip_length=self.trip_length,
+                error_offset=self.error_offset,
+                error_length=self.error_length,
+                d_port_id=self.d_port_id,
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, manifest_dir)
+
+    def match(self, keys: np.ndarray, hashes: np.ndarray) -> np.ndarray:
+        # manifest row of every unchanged new row (same key and content), -1 otherwise
+        order = np.argsort(self.keys, kind="stable")
+        sorted_keys = self.keys[order]
+        positions = np.minimum(np.searchsorted(sorted_keys, keys), max(len(order) - 1, 0))
+        old_row = np.full(len(keys), -1, dtype=np.int64)
+        if len(order) == 0:
+            return old_row
+        candidate = order[positions]
+        same = (sorted_keys[positions] == keys) & (self.hashes[candidate] == hashes)
+        old_row[same] = candidate[same]
+        return old_row
+
+
+def _output_signature(output_dir: str, error_dir: str) -> tp.List[int]:
+    signature = []
+    for file_dir in [output_dir, error_dir]:
+        stat = os.stat(file_dir)
+        signature += [stat.st_size, stat.st_mtime_ns]
+    return signature
+
+
+def input_signature(scorer) -> str:
+    # port reference data, vessel file and NIS parameters of scorer
+    vessel_dir = scorer.paths[1]
+    return json.dumps(
+        {
+            "ports": scorer.record_parser.port_parser.source_signature,
+            "vessels": f"{Path(vessel_dir).resolve()}:{_file_signature(vessel_dir)}",
+            "nis": scorer.nis.parameters(),
+        },
+        sort_keys=True,
+    )
+
+
+def record_keys(
+    record_parser: RecordParser, chunk_size: int = RECORD_CHUNK_SIZE
+) -> tp.Tuple[np.ndarray, np.ndarray]:
+    # key and content hash (uint64) of every record row
+    identities = []
+    hashes = []
+    for chunk in record_parser.iter_chunks(chunk_size):
+        identities.append(
+            pd.util.hash_pandas_object(chunk[IDENTITY_COLUMNS], index=False).to_numpy()
+        )
+        hashes.append(pd.util.hash_pandas_object(chunk, index=False).to_numpy())
+    identity = np.concatenate(identities) if identities else np.empty(0, np.uint64)
+    # repeated port calls of the same triple are told apart by their occurrence
+    occurrence = pd.Series(identity).groupby(identity, sort=False).cumcount().to_numpy()
+    with np.errstate(over="ignore"):
+        keys = identity ^ (occurrence.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15))
+    content = np.concatenate(hashes) if hashes else np.empty(0, np.uint64)
+    return keys, content
+
+
+def _map_file(file_dir: str) -> tp.Union[mmap.mmap, bytes]:
+    try:
+        with open(file_dir, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b""
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        return b""
+
+
+def refresh(
+    scorer,
+    record_dir: str,
+    output_dir: str,
+    error_dir: str,
+    chunk_size: int = RECORD_CHUNK_SIZE,
+    score_chunks: tp.Optional[tp.Callable] = None,
+) -> tp.Dict[str, tp.Any]:
+    # bring output / error files up to date with record_dir, scoring only the delta
+    # scorer: process_origin_trips.TripScorer; without a valid manifest every row is new
+    # score_chunks: (key, chunk) pairs -> (key, scorer.score_rows(chunk)) in order, such
+    # as process_origin_trips.iter_scored_rows on the pool; None scores here
+    # return the row counts and the affected d_port_ids (also in <output>.delta.json)
+    record_parser = scorer.record_parser.with_record(record_dir)
+    if score_chunks is None:
+        score_chunks = lambda chunks: (
+            (key, scorer.score_rows(chunk) if len(chunk) else ({}, {}))
+            for key, chunk in chunks
+        )
+    with scorer.stats.stage("read"):
+        keys, hashes = record_keys(record_parser, chunk_size)
+    inputs = input_signature(scorer)
+    old = TripManifest.load(output_dir, error_dir, inputs)
+    # only a cube of outputs the manifest accounts for can be patched
+    cube = RiskCube.load(output_dir) if old is not None else None
+    if old is None:
+        old = TripManifest(np.empty(0, np.uint64), np.empty(0, np.uint64))
+    old_row = old.match(keys, hashes)
+    new = TripManifest(keys, hashes)
+
+    kept = np.zeros(len(old), dtype=bool)
+    kept[old_row[old_row >= 0]] = True
+    old_trips = _map_file(output_dir)
+    old_errors = _map_file(error_dir)
+    # ports of the trips that go away (changed or deleted rows)
+    d_port_ids = set(old.d_port_id[~kept].tolist())
+
+    temp_output = f"{output_dir}.tmp"
+    temp_error = f"{error_dir}.tmp"
+    writer = _SegmentWriter(old, new, old_trips, old_errors)
+    try:
+        with open(temp_output, "wb") as trip_file, open(temp_error, "wb") as error_file:
+            writer.trip_file, writer.error_file = trip_file, error_file
+            for (rows, source, delta), (trip_lines, error_lines) in score_chunks(
+                _delta_chunks(record_parser, chunk_size, old_row)
+            ):
+                with scorer.stats.stage("write"):
+                    # unchanged runs copied as one block, changed rows one by one
+                    starts = np.flatnonzero(
+                        np.r_[True, delta[1:] | delta[:-1] | (np.diff(source) != 1)]
+                    )
+                    for a, b in zip(starts, np.r_[starts[1:], len(rows)]):
+                        if delta[a]:
+                            writer.write_row(
+                                rows[a], trip_lines.get(rows[a]), error_lines.get(rows[a])
+                            )
+                            d_port_ids.add(int(new.d_port_id[rows[a]]))
+                        else:
+                            writer.copy_rows(rows[a:b], source[a:b])
+                scorer.stats.count(int(delta.sum()), len(error_lines))
+            trip_file.flush()
+            os.fsync(trip_file.fileno())
+            error_file.flush()
+            os.fsync(error_file.fileno())
+    finally:
+        for mapped in [old_trips, old_errors]:
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+    os.replace(temp_output, output_dir)
+    os.replace(temp_error, error_dir)
+    new.save(output_dir, error_dir, inputs)
+    d_port_ids.discard(-1)
+    if cube is not None:
+        with scorer.stats.stage("aggregate"):
+            _patch_cube(cube, new, output_dir, d_port_ids, scorer.record_parser.port_parser)
+
+    delta = {
+        "record": str(record_dir),
+        "rows": len(keys),
+        "unchanged": int((old_row >= 0).sum()),
+        "scored": int((old_row < 0).sum()),
+        "deleted": int((~kept).sum()),
+        "d_port_ids": sorted(d_port_ids),
+    }
+    with open(f"{output_dir}.delta.json", "w") as f:
+        json.dump(delta, f, indent=2)
+    return delta
+
+
+def _delta_chunks(
+    record_parser: RecordParser, chunk_size: int, old_row: np.ndarray
+) -> tp.Iterator[tp.Tuple[tp.Tuple[np.ndarray, np.ndarray, np.ndarray], pd.DataFrame]]:
+    # ((rows, old rows, delta mask), new or changed rows) of every record block
+    for chunk in record_parser.iter_chunks(chunk_size):
+        rows = chunk.index.to_numpy()
+        source = old_row[rows]
+        delta = source < 0
+        yield (rows, source, delta), chunk[delta]
+
+
+def _patch_cube(
+    cube: RiskCube,
+    manifest: TripManifest,
+    output_dir: str,
+    d_port_ids: tp.Set[int],
+    port_parser,
+) -> None:
+    # rebuild the cells of d_port_ids from their trips in the refreshed output
+    rows = np.flatnonzero(np.isin(manifest.d_port_id, sorted(d_port_ids)))
+    trips = _map_file(output_dir)
+    try:
+        block = b"".join(
+            trips[start : start + length]
+            for start, length in zip(manifest.trip_offset[rows], manifest.trip_length[rows])
+        )
+    finally:
+        if isinstance(trips, mmap.mmap):
+            trips.close()
+    port_trips = (
+        read_pipe_file(io.BytesIO(block), TRIP_SCHEMA, header=False)
+        if block
+        else pd.DataFrame(columns=list(TRIP_SCHEMA))
+    )
+    cube.replace_ports(
+        d_port_ids, risk_trips(port_trips), port_parser, trip_signature(output_dir)
+    ).save(output_dir)
+
+
+def _lines(block: bytes) -> tp.List[bytes]:
+    return [line + b"\n" for line in block.split(b"\n")[:-1]]
+
+
+def _d_port_id(line: bytes) -> tp.Optional[int]:
+    try:
+        return int(bytes(line).split(b"|")[D_PORT_ID_FIELD])
+    except (IndexError, ValueError):
+        return None
+
+
+class _SegmentWriter:
+    # appends rows to the new outputs and fills their manifest offsets
+    def __init__(self, old: TripManifest, new: TripManifest, old_trips, old_errors) -> None:
+        self.old = old
+        self.new = new
+        self.old_trips = old_trips
+        self.old_errors = old_errors
+        self.trip_file: tp.Optional[tp.IO] = None
+        self.error_file: tp.Optional[tp.IO] = None
+        self.trip_position = 0
+        self.error_position = 0
+
+    def write_row(
+        self, row: int, trip_line: tp.Optional[str], error_line: tp.Optional[str]
+    ) -> None:
+        trip = trip_line.encode() if trip_line is not None else b""
+        error = error_line.encode() if error_line is not None else b""
+        self.new.trip_offset[row] = self.trip_position
+        self.new.trip_length[row] = len(trip)
+        self.new.error_offset[row] = self.error_position
+        self.new.error_length[row] = len(error)
+        d_port_id = _d_port_id(trip) if trip else None
+        self.new.d_port_id[row] = d_port_id if d_port_id is not None else -1
+        self.trip_file.write(trip)
+        self.error_file.write(error)
+        self.trip_position += len(trip)
+        self.error_position += len(error)
+
+    def copy_rows(self, rows: np.ndarray, source: np.ndarray) -> None:
+        # consecutive new rows whose old rows are consecutive too
+        old = self.old
+        start = old.trip_offset[source[0]]
+        end = old.trip_offset[source[-1]] + old.trip_length[source[-1]]
+        self.trip_file.write(self.old_trips[start:end])
+        self.new.trip_offset[rows] = self.trip_position + old.trip_offset[source] - start
+        self.new.trip_length[rows] = old.trip_length[source]
+        self.new.d_port_id[rows] = old.d_port_id[source]
+        self.trip_position += end - start
+
+        start = old.error_offset[source[0]]
+        end = old.error_offset[source[-1]] + old.error_length[source[-1]]
+        shift = int(rows[0] - source[0])
+        if shift == 0:
+            block = bytes(self.old_errors[start:end])
+            lengths = old.error_length[source]
+        else:
+            # error lines start with the record row, which moved by shift
+            lines = [
+                b"%d|%s" % (int(row) + shift, rest)
+                for row, rest in (
+                    line.split(b"|", 1)
+                    for line in _lines(bytes(self.old_errors[start:end]))
+                )
+            ]
+            block = b"".join(lines)
+            lengths = np.zeros(len(rows), dtype=np.int64)
+            lengths[old.error_length[source] > 0] = [len(line) for line in lines]
+        self.error_file.write(block)
+        self.new.error_offset[rows] = self.error_position + np.concatenate(
+            [[0], np.cumsum(lengths)[:-1]]
+        )
+        self.new.error_length[rows] = lengths
+        self.error_position += len(block)
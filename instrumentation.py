@@ -0,0 +1,113 @@
+# stage timing and throughput counters of the trip pipeline
+# cumulative seconds / calls per stage, rows and error rows, a progress line every
+# report_interval seconds and a json summary at the end of a run
+# worker processes keep their own PipelineStats and hand the stage counters to the
+# parent with take_stages / merge_stages
+import contextlib
+import json
+import time
+import typing as tp
+
+# stages of process_origin_trips in pipeline order
+# read: record file parsing, port / vessel: reference lookups, distance: route cache,
+# score: NIS scoring, format: output text, wait: parent idle on the pool,
+# queue: parent blocked on a full writer queue, write: output (writer thread)
+STAGES = ("read", "port", "vessel", "distance", "score", "format", "wait", "queue", "write")
+# seconds between two progress lines
+REPORT_INTERVAL = 30.0
+
+
+class PipelineStats:
+    def __init__(
+        self,
+        report_interval: float = REPORT_INTERVAL,
+        report: tp.Callable[[str], None] = print,
+    ) -> None:
+        self.report_interval = report_interval
+        self.report = report
+        self.started = time.perf_counter()
+        self._last_report = self.started
+        self.seconds = {name: 0.0 for name in STAGES}
+        self.calls = {name: 0 for name in STAGES}
+        self.rows = 0
+        self.errors = 0
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> tp.Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def count(self, rows: int, errors: int) -> None:
+        self.rows += rows
+        self.errors += errors
+
+    def take_stages(self) -> tp.Dict[str, tp.Tuple[float, int]]:
+        # stage counters since the last call, reset afterwards
+        stages = {
+            name: (self.seconds[name], self.calls[name])
+            for name in self.seconds
+            if self.calls[name]
+        }
+        self.seconds = {name: 0.0 for name in self.seconds}
+        self.calls = {name: 0 for name in self.calls}
+        return stages
+
+    def merge_stages(self, stages: tp.Dict[str, tp.Tuple[float, int]]) -> None:
+        for name, (seconds, calls) in stages.items():
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + calls
+
+    def maybe_report(self) -> None:
+        # progress line when report_interval passed since the last one, <= 0 never
+        now = time.perf_counter()
+        if self.report_interval > 0 and now - self._last_report >= self.report_interval:
+            self._last_report = now
+            self.report(self.progress_line())
+
+    def progress_line(self) -> str:
+        elapsed = time.perf_counter() - self.started
+        slowest = max(self.seconds, key=self.seconds.get)
+        return (
+            f"{self.rows} rows in {elapsed:.1f}s "
+            f"({self.rows / max(elapsed, 1e-9):.0f} rows/s), "
+            f"error rate {self.errors / max(self.rows, 1):.2%}, "
+            f"slowest stage {slowest} {self.seconds[slowest]:.1f}s"
+        )
+
+    def summary(self) -> tp.Dict[str, tp.Any]:
+        # stage seconds of workers add up across processes, so shares can exceed elapsed
+        elapsed = time.perf_counter() - self.started
+        staged = sum(self.seconds.values())
+        return {
+            "elapsed_seconds": elapsed,
+            "rows": self.rows,
+            "error_rows": self.errors,
+            "rows_per_second": self.rows / max(elapsed, 1e-9),
+            "error_rate": self.errors / max(self.rows, 1),
+            "stages": {
+                name: {
+                    "seconds": self.seconds[name],
+                    "calls": self.calls[name],
+                    "share": self.seconds[name] / staged if staged else 0.0,
+                }
+                for name in self.seconds
+            },
+            "slowest_stage": max(self.seconds, key=self.seconds.get),
+        }
+
+    def write_json(self, json_dir: str) -> None:
+        with open(json_dir, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+def stage(
+    stats: tp.Optional[PipelineStats], name: str
+) -> tp.ContextManager[None]:
+    # stats.stage(name), or nothing when the caller runs without stats
+    if stats is None:
+        return contextlib.nullcontext()
+    return stats.stage(name)
@@ -0,0 +1,226 @@
+# Monte Carlo uncertainty of the aggregate port risk
+# every sample draws the uncertain NIS coefficients once and the uncertain trip
+# inputs (ballast volume, temperature / salinity gap) once per trip, then scores
+# the prepared trips of a ParameterSweep; only the per-port aggregate of every
+# sample is kept (samples x ports), never samples x trips
+# sample blocks run in a process pool attached to the trip arrays in shared memory
+import os
+import typing as tp
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import attr
+import numpy as np
+import pandas as pd
+
+from nis_probability import NIS_PARAMETERS
+from parameter_sweep import SWEEP_BLOCK_SIZE, ParameterSweep
+from survival import risk_from_log_survival
+
+# samples handed to a worker at once
+MONTE_CARLO_SAMPLE_BLOCK = 64
+DEFAULT_PERCENTILES = (5.0, 50.0, 95.0)
+# uncertain trip inputs, drawn per trip and sample
+# temperature / salinity perturb the destination - origin gap
+TRIP_INPUTS = {
+    "ballast_discharge": "ballast_water",
+    "temperature": "dt",
+    "salinity": "ds",
+}
+
+
+@attr.s(frozen=True)
+class Uncertainty:
+    # distribution of one input around its base value
+    # normal: base + N(0, scale)
+    # lognormal: base * exp(N(-scale**2 / 2, scale)), same mean as base
+    # uniform: base * U(1 - scale, 1 + scale)
+    distribution = attr.ib(default="normal")
+    scale = attr.ib(default=0.0)
+
+    @distribution.validator
+    def _check_distribution(self, attribute, value):
+        if value not in ("normal", "lognormal", "uniform"):
+            raise ValueError(f"unknown distribution {value}")
+
+    def draw(
+        self, rng: np.random.Generator, base: np.ndarray, size: tp.Tuple[int, ...]
+    ) -> np.ndarray:
+        if self.distribution == "normal":
+            return base + rng.normal(0.0, self.scale, size)
+        if self.distribution == "lognormal":
+            return base * np.exp(rng.normal(-0.5 * self.scale**2, self.scale, size))
+        return base * rng.uniform(1.0 - self.scale, 1.0 + self.scale, size)
+
+
+class MonteCarlo:
+    def __init__(
+        self,
+        sweep: ParameterSweep,
+        uncertainties: tp.Dict[str, Uncertainty],
+        samples: int = 1000,
+        seed: int = 0,
+        workers: tp.Optional[int] = None,
+        sample_block: int = MONTE_CARLO_SAMPLE_BLOCK,
+        block_size: int = SWEEP_BLOCK_SIZE,
+    ):
+        # uncertainties: NIS_PARAMETERS or TRIP_INPUTS names
+        unknown = [
+            name
+            for name in uncertainties
+            if name not in NIS_PARAMETERS and name not in TRIP_INPUTS
+        ]
+        if unknown:
+            raise ValueError(f"unknown uncertain inputs {unknown}")
+        self.sweep = sweep
+        self.uncertainties = dict(uncertainties)
+        self.samples = samples
+        self.seed = seed
+        self.workers = workers if workers is not None else os.cpu_count() or 1
+        self.sample_block = sample_block
+        self.block_size = block_size
+
+    def _tasks(self) -> tp.List[tp.Tuple[int, int, np.random.SeedSequence]]:
+        # one seed per sample block: results do not depend on the worker count
+        starts = list(range(0, self.samples, self.sample_block))
+        seeds = np.random.SeedSequence(self.seed).spawn(len(starts))
+        return [
+            (start, min(self.sample_block, self.samples - start), seed)
+            for start, seed in zip(starts, seeds)
+        ]
+
+    def iter_blocks(self) -> tp.Iterator[tp.Tuple[int, np.ndarray, np.ndarray]]:
+        # (first sample, ballast risk, biofouling risk) of every sample block in order
+        # risks are (block samples, ports) aggregates
+        config = (
+            self.sweep.nis.parameters(),
+            self.uncertainties,
+            self.sweep.groups,
+            self.block_size,
+        )
+        tasks = self._tasks()
+        if self.workers <= 1:
+            _init_worker(None, self.sweep.trip_arrays, config)
+            try:
+                for task in tasks:
+                    yield _run_block(task)
+            finally:
+                _WORKER.clear()
+            return
+
+        arrays = self.sweep.trip_arrays
+        layout = [(name, values.dtype.str, len(values)) for name, values in arrays.items()]
+        size = max(1, sum(values.nbytes for values in arrays.values()))
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        try:
+            for name, values in _attach(shm, layout).items():
+                values[:] = arrays[name]
+            with ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_init_worker,
+                initargs=(shm.name, layout, config),
+            ) as executor:
+                yield from executor.map(_run_block, tasks)
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def run(self) -> tp.Tuple[np.ndarray, np.ndarray]:
+        # (samples, ports) aggregate ballast / biofouling risk
+        ballast = np.empty((self.samples, len(self.sweep.groups)))
+        biofouling = np.empty((self.samples, len(self.sweep.groups)))
+        for start, block_ballast, block_biofouling in self.iter_blocks():
+            ballast[start : start + len(block_ballast)] = block_ballast
+            biofouling[start : start + len(block_biofouling)] = block_biofouling
+        return ballast, biofouling
+
+    def summary(
+        self, percentiles: tp.Sequence[float] = DEFAULT_PERCENTILES
+    ) -> pd.DataFrame:
+        # mean and percentiles of the aggregate risk per port
+        # columns ballast_mean, ballast_p5, ..., biofouling_p95
+        ballast, biofouling = self.run()
+        return summarize(ballast, biofouling, self.sweep.groups, percentiles)
+
+
+def summarize(
+    ballast: np.ndarray,
+    biofouling: np.ndarray,
+    groups: pd.Index,
+    percentiles: tp.Sequence[float] = DEFAULT_PERCENTILES,
+) -> pd.DataFrame:
+    summary = pd.DataFrame(index=groups)
+    for name, risk in [("ballast", ballast), ("biofouling", biofouling)]:
+        summary[f"{name}_mean"] = risk.mean(axis=0)
+        for percentile, values in zip(
+            percentiles, np.percentile(risk, percentiles, axis=0)
+        ):
+            summary[f"{name}_p{percentile:g}"] = values
+    return summary
+
+
+# state of a pool worker (or of the parent when workers <= 1)
+_WORKER: tp.Dict[str, tp.Any] = dict()
+
+
+def _attach(
+    shm: shared_memory.SharedMemory, layout: tp.Sequence[tp.Tuple[str, str, int]]
+) -> tp.Dict[str, np.ndarray]:
+    arrays = dict()
+    offset = 0
+    for name, dtype, length in layout:
+        arrays[name] = np.ndarray((length,), dtype=dtype, buffer=shm.buf, offset=offset)
+        offset += arrays[name].nbytes
+    return arrays
+
+
+def _init_worker(shm_name, arrays_or_layout, config) -> None:
+    parameters, uncertainties, groups, block_size = config
+    if shm_name is None:
+        arrays = arrays_or_layout
+    else:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _WORKER["shm"] = shm
+        arrays = _attach(shm, arrays_or_layout)
+    _WORKER["sweep"] = ParameterSweep.from_arrays(arrays, groups)
+    _WORKER["parameters"] = parameters
+    _WORKER["uncertainties"] = uncertainties
+    _WORKER["block_size"] = block_size
+
+
+def _run_block(
+    task: tp.Tuple[int, int, np.random.SeedSequence]
+) -> tp.Tuple[int, np.ndarray, np.ndarray]:
+    start, count, seed = task
+    sweep: ParameterSweep = _WORKER["sweep"]
+    uncertainties: tp.Dict[str, Uncertainty] = _WORKER["uncertainties"]
+    rng = np.random.default_rng(seed)
+
+    parameters = dict()
+    for name, base in _WORKER["parameters"].items():
+        if name in uncertainties:
+            parameters[name] = uncertainties[name].draw(rng, float(base), (count, 1))
+        else:
+            parameters[name] = np.full((count, 1), float(base))
+
+    arrays = sweep.trip_arrays
+    n_trips = sweep.scored_count
+    trip_block = max(1, min(n_trips, _WORKER["block_size"] // count))
+    log_ballast = np.zeros((count, len(sweep.groups)))
+    log_biofouling = np.zeros((count, len(sweep.groups)))
+    for trip_start in range(0, n_trips, trip_block):
+        trips = slice(trip_start, trip_start + trip_block)
+        inputs = {
+            TRIP_INPUTS[name]: uncertainty.draw(
+                rng, arrays[TRIP_INPUTS[name]][trips], (count, len(arrays["stay"][trips]))
+            )
+            for name, uncertainty in uncertainties.items()
+            if name in TRIP_INPUTS
+        }
+        if "ballast_water" in inputs:
+            # a drawn volume can not be negative
+            inputs["ballast_water"] = np.maximum(inputs["ballast_water"], 0.0)
+        p_ballast, p_biofouling = sweep.evaluate(parameters, trips, inputs)
+        sweep.add_log_survival(log_ballast, p_ballast, trips)
+        sweep.add_log_survival(log_biofouling, p_biofouling, trips)
+    return start, risk_from_log_survival(log_ballast), risk_from_log_survival(log_biofouling)
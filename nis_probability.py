@@ -6,7 +6,35 @@ import typing as tp
 import numpy as np
 import pandas as pd
 
-from parsers import PortInfo, VoyageTrip
+from parsers import (
+    SNAPSHOT_DIR,
+    PortInfo,
+    PortPairCache,
+    PortParser,
+    RegionAdjacency,
+    VoyageTrip,
+)
+
+# persisted EstablishmentCache of process_origin_trips
+ESTABLISH_CACHE_DIR = SNAPSHOT_DIR.joinpath("establish_factor.npz")
+
+# model coefficients of NIS._init_parameters, the ones a ParameterSweep can vary
+NIS_PARAMETERS = (
+    "establish_alpha",
+    "establish_temp_standard",
+    "establish_salinity_standard",
+    "ballast_lambda",
+    "ballast_mu",
+    "treatment",
+    "biofuling_tro_1",
+    "biofuling_tro_2",
+    "biofuling_tro_3",
+    "biofuling_tem_1",
+    "biofuling_tem_2",
+    "biofuling_tem_3",
+    "biofuling_gama",
+    "biofuling_tropical_lat",
+)
 
 
 class NIS:
@@ -32,6 +60,18 @@ class NIS:
         self.biofuling_gama = 0.008
         self.biofuling_tropical_lat = 0.35
 
+    def parameters(self) -> tp.Dict[str, float]:
+        return {name: getattr(self, name) for name in NIS_PARAMETERS}
+
+    def _coefficient(
+        self, name: str, parameters: tp.Optional[tp.Dict[str, np.ndarray]]
+    ) -> tp.Union[float, np.ndarray]:
+        # parameters[name] when given (e.g. (sets, 1) arrays of a ParameterSweep, broadcast
+        # against the voyage arrays), the NIS value otherwise
+        if parameters is not None and name in parameters:
+            return parameters[name]
+        return getattr(self, name)
+
     def biofouling_probability(
         self,
         origin_port_lat: float,
@@ -40,7 +80,7 @@ class NIS:
         stay_duration: float,
     ) -> float:
         A = math.exp(-self.biofuling_gama * avg_sog)
-        if abs(origin_port_lat) <= 0.35:
+        if abs(origin_port_lat) <= self.biofuling_tropical_lat:
             prob = (
                 anti_p
                 * (
@@ -113,6 +153,179 @@ class NIS:
         p_biofouling = p_indigenous * p_establish * p_by_biofouling
         return [p_ballast, p_biofouling]
 
+    def calculate_batch(
+        self,
+        dt: np.ndarray,
+        ds: np.ndarray,
+        ballast_water: np.ndarray,
+        voyage_duration: np.ndarray,
+        stay_duration: np.ndarray,
+        origin_port_lat: np.ndarray,
+        anti_p: np.ndarray,
+        avg_sog: np.ndarray,
+        p_indigenous: tp.Optional[np.ndarray] = None,
+        treatment: tp.Optional[tp.Union[float, np.ndarray]] = None,
+    ) -> tp.Tuple[np.ndarray, np.ndarray]:
+        # array form of calculate_by_voyage, one element per voyage
+        # return ballast / biofouling risk arrays
+        p_factor = self.establish_factor_batch(dt, ds, p_indigenous)
+        return self.combine_batch(
+            p_factor,
+            self.ballast_intro_batch(ballast_water, voyage_duration, treatment),
+            self.biofouling_batch(origin_port_lat, anti_p, avg_sog, stay_duration),
+        )
+
+    def establish_factor_batch(
+        self,
+        dt: np.ndarray,
+        ds: np.ndarray,
+        p_indigenous: tp.Optional[np.ndarray] = None,
+        parameters: tp.Optional[tp.Dict[str, np.ndarray]] = None,
+    ) -> np.ndarray:
+        # p_indigenous * p_establish, only depends on the origin / destination ports
+        # parameters: NIS_PARAMETERS arrays in place of the NIS values (_coefficient)
+        dt = np.asarray(dt, dtype=float)
+        ds = np.asarray(ds, dtype=float)
+        if p_indigenous is None:
+            p_indigenous = np.ones_like(dt)
+        p_establish = self._coefficient("establish_alpha", parameters) * np.exp(
+            -0.5
+            * (
+                (dt / self._coefficient("establish_temp_standard", parameters)) ** 2
+                + (ds / self._coefficient("establish_salinity_standard", parameters)) ** 2
+            )
+        )
+        return np.where(p_indigenous == 0, 0.0, p_indigenous * p_establish)
+
+    def ballast_intro_batch(
+        self,
+        ballast_water: np.ndarray,
+        voyage_duration: np.ndarray,
+        treatment: tp.Optional[tp.Union[float, np.ndarray]] = None,
+        parameters: tp.Optional[tp.Dict[str, np.ndarray]] = None,
+    ) -> np.ndarray:
+        if treatment is None:
+            treatment = self._coefficient("treatment", parameters)
+        ballast_water = np.asarray(ballast_water, dtype=float)
+        voyage_duration = np.asarray(voyage_duration, dtype=float)
+        return (
+            treatment
+            * (1 - np.exp(-self._coefficient("ballast_lambda", parameters) * ballast_water))
+            * np.exp(-self._coefficient("ballast_mu", parameters) * voyage_duration)
+        )
+
+    def biofouling_batch(
+        self,
+        origin_port_lat: np.ndarray,
+        anti_p: np.ndarray,
+        avg_sog: np.ndarray,
+        stay_duration: np.ndarray,
+        parameters: tp.Optional[tp.Dict[str, np.ndarray]] = None,
+    ) -> np.ndarray:
+        origin_port_lat = np.asarray(origin_port_lat, dtype=float)
+        anti_p = np.asarray(anti_p, dtype=float)
+        avg_sog = np.asarray(avg_sog, dtype=float)
+        stay_duration = np.asarray(stay_duration, dtype=float)
+        coefficient = lambda name: self._coefficient(name, parameters)
+        # tropical / temperate polynomial chosen by origin latitude
+        tropical = np.abs(origin_port_lat) <= coefficient("biofuling_tropical_lat")
+        c1 = np.where(tropical, coefficient("biofuling_tro_1"), coefficient("biofuling_tem_1"))
+        c2 = np.where(tropical, coefficient("biofuling_tro_2"), coefficient("biofuling_tem_2"))
+        c3 = np.where(tropical, coefficient("biofuling_tro_3"), coefficient("biofuling_tem_3"))
+        return (
+            anti_p
+            * (c1 * stay_duration**3 - c2 * stay_duration**2 + c3 * stay_duration)
+            * np.exp(-coefficient("biofuling_gama") * avg_sog)
+        )
+
+    @staticmethod
+    def combine_batch(
+        p_factor: np.ndarray, p_by_ballast: np.ndarray, p_by_biofouling: np.ndarray
+    ) -> tp.Tuple[np.ndarray, np.ndarray]:
+        # calculate_by_voyage returns zeros for same-region voyages whatever the rest is
+        p_ballast = np.where(p_factor == 0, 0.0, p_factor * p_by_ballast)
+        p_biofouling = np.where(p_factor == 0, 0.0, p_factor * p_by_biofouling)
+        return p_ballast, p_biofouling
+
+    def calculate_trip_table(
+        self,
+        trips: pd.DataFrame,
+        port_parser: PortParser,
+        establish_cache: tp.Optional["EstablishmentCache"] = None,
+    ) -> pd.DataFrame:
+        # score a trip table of RecordParser.process_records_batch
+        # return it with ballast_risk / biofouling_risk columns
+        if establish_cache is not None:
+            (p_factor,) = establish_cache.lookup(
+                trips["o_port_id"].to_numpy(), trips["d_port_id"].to_numpy()
+            )
+        else:
+            p_factor = self.establish_factor_trips(trips, port_parser)
+        p_ballast, p_biofouling = self.combine_batch(
+            p_factor,
+            self.ballast_intro_batch(
+                trips["ballast_discharge"].to_numpy(),
+                trips["voyage_duration"].to_numpy(),
+            ),
+            self.biofouling_batch(
+                trips["o_port_lat"].to_numpy(),
+                trips["antifouling_factor"].to_numpy(),
+                trips["spd"].to_numpy(),
+                trips["stay_duration"].to_numpy(),
+            ),
+        )
+        trips = trips.copy()
+        trips["ballast_risk"] = p_ballast
+        trips["biofouling_risk"] = p_biofouling
+        return trips
+
+    def establish_factor_trips(
+        self, trips: pd.DataFrame, port_parser: PortParser
+    ) -> np.ndarray:
+        # establish_factor_batch from the port columns of a trip (or port pair) table
+        p_indigenous = self.indigenous_batch(
+            trips["o_meow_code"].to_numpy(),
+            trips["d_meow_code"].to_numpy(),
+            trips["o_feow_code"].to_numpy(),
+            trips["d_feow_code"].to_numpy(),
+            port_parser.meow_adjacency,
+            port_parser.feow_adjacency,
+        )
+        return self.establish_factor_batch(
+            dt=np.abs(trips["d_yr_mean_t"].to_numpy() - trips["o_yr_mean_t"].to_numpy()),
+            ds=np.abs(trips["d_salinity"].to_numpy() - trips["o_salinity"].to_numpy()),
+            p_indigenous=p_indigenous,
+        )
+
+    def indigenous_batch(
+        self,
+        origin_meow: np.ndarray,
+        desti_meow: np.ndarray,
+        origin_feow: np.ndarray,
+        desti_feow: np.ndarray,
+        meow_adjacency: RegionAdjacency,
+        feow_adjacency: RegionAdjacency,
+    ) -> np.ndarray:
+        # array form of process_indigenous over RegionAdjacency codes (-1: no region)
+        p_indigenous = np.ones(len(origin_meow))
+        meow = (origin_meow >= 0) & (desti_meow >= 0)
+        p_indigenous[meow] = self._indigenous_by_code(
+            origin_meow[meow], desti_meow[meow], meow_adjacency
+        )
+        feow = ~meow & (origin_feow >= 0) & (desti_feow >= 0)
+        p_indigenous[feow] = self._indigenous_by_code(
+            origin_feow[feow], desti_feow[feow], feow_adjacency
+        )
+        return p_indigenous
+
+    @staticmethod
+    def _indigenous_by_code(
+        origin: np.ndarray, desti: np.ndarray, adjacency: RegionAdjacency
+    ) -> np.ndarray:
+        same = adjacency.region_of[origin] == adjacency.region_of[desti]
+        listed = adjacency.listed[origin] | adjacency.listed[desti]
+        return np.where(~same, 1.0, np.where(listed, 0.5, 0.0))
+
     def process_indigenous(self, port_s: PortInfo, port_d: PortInfo) -> None:
         if port_s.has_meow_region and port_d.has_meow_region:
             if port_s.meow_region != port_d.meow_region:
@@ -133,3 +346,40 @@ class NIS:
         return 1.0
 
 
+class EstablishmentCache(PortPairCache):
+    # p_indigenous * p_establish of origin -> destination port id pairs
+    # valid for one env / place file and one set of establishment parameters
+    value_names = ("establish_factor",)
+
+    def __init__(
+        self, nis: NIS, port_parser: PortParser, cache_dir: tp.Optional[str] = None
+    ) -> None:
+        self.nis = nis
+        self.port_parser = port_parser
+        super().__init__(cache_dir)
+
+    def _compute(self, keys: np.ndarray) -> tp.Sequence[np.ndarray]:
+        origin_ids, desti_ids = self.split_key(keys)
+        origin = self.port_parser.get_ports(origin_ids)
+        desti = self.port_parser.get_ports(desti_ids)
+        pairs = pd.DataFrame(
+            {
+                "o_meow_code": origin["meow_code"].fillna(-1).to_numpy(dtype=np.int64),
+                "d_meow_code": desti["meow_code"].fillna(-1).to_numpy(dtype=np.int64),
+                "o_feow_code": origin["feow_code"].fillna(-1).to_numpy(dtype=np.int64),
+                "d_feow_code": desti["feow_code"].fillna(-1).to_numpy(dtype=np.int64),
+                "o_yr_mean_t": origin["yr_mean_t"].to_numpy(),
+                "d_yr_mean_t": desti["yr_mean_t"].to_numpy(),
+                "o_salinity": origin["salinity"].to_numpy(),
+                "d_salinity": desti["salinity"].to_numpy(),
+            }
+        )
+        return (self.nis.establish_factor_trips(pairs, self.port_parser),)
+
+    def _cache_signature(self) -> str:
+        parameters = (
+            self.nis.establish_alpha,
+            self.nis.establish_temp_standard,
+            self.nis.establish_salinity_standard,
+        )
+        return f"{self.port_parser.source_signature}|{parameters}"
@@ -0,0 +1,194 @@
+# evaluate many NIS coefficient sets over one fixed trip table
+# trip terms that do not depend on the coefficients are computed once, then every
+# block of parameter sets is broadcast against a block of trips and aggregated per
+# destination port: 1 - prod(1 - risk) as AggregateRisk.aggregate_one_port
+import itertools
+import typing as tp
+
+import numpy as np
+import pandas as pd
+
+from nis_probability import NIS, NIS_PARAMETERS
+from parsers import TRIP_SCORE_COLUMNS, PortParser, RecordParser
+from survival import log_survival, risk_from_log_survival
+
+# parameter sets x trips of one broadcast block (float64 elements per array)
+SWEEP_BLOCK_SIZE = 4000000
+# trip table columns a ParameterSweep needs
+SWEEP_COLUMNS = ["d_port_id", "o_port_lat", "spd", "voyage_duration", "stay_duration"]
+
+
+def parameter_grid(**values: tp.Sequence[float]) -> pd.DataFrame:
+    # every combination of the given coefficient values, one row per parameter set
+    # coefficients not given keep the NIS default in ParameterSweep.run
+    names = list(values)
+    return pd.DataFrame(
+        list(itertools.product(*[list(values[name]) for name in names])),
+        columns=names,
+    ).rename_axis("set")
+
+
+class ParameterSweep:
+    def __init__(
+        self,
+        trips: pd.DataFrame,
+        port_parser: PortParser,
+        nis: tp.Optional[NIS] = None,
+        group_column: str = "d_port_id",
+    ):
+        # trips: RecordParser.process_records_batch table (SWEEP_COLUMNS + TRIP_SCORE_COLUMNS)
+        self.nis = nis if nis is not None else NIS()
+        self.group_column = group_column
+        self.trip_count = len(trips)
+
+        codes, groups = pd.factorize(trips[group_column], sort=True)
+        self.groups = pd.Index(groups, name=group_column)
+        p_indigenous = self.nis.indigenous_batch(
+            trips["o_meow_code"].to_numpy(),
+            trips["d_meow_code"].to_numpy(),
+            trips["o_feow_code"].to_numpy(),
+            trips["d_feow_code"].to_numpy(),
+            port_parser.meow_adjacency,
+            port_parser.feow_adjacency,
+        )
+        # same-region voyages score 0 under every parameter set
+        keep = (p_indigenous != 0) & (codes >= 0)
+        order = np.argsort(codes[keep], kind="stable")
+        trips = trips[keep].iloc[order]
+
+        def column(name: str) -> np.ndarray:
+            return trips[name].to_numpy(dtype=float, na_value=np.nan)
+
+        # per-trip terms, sorted by group
+        self._trips = {
+            "group_code": codes[keep][order],
+            "p_indigenous": p_indigenous[keep][order],
+            "dt": column("d_yr_mean_t") - column("o_yr_mean_t"),
+            "ds": column("d_salinity") - column("o_salinity"),
+            "ballast_water": column("ballast_discharge"),
+            "voyage_duration": column("voyage_duration"),
+            "abs_lat": np.abs(column("o_port_lat")),
+            "anti_p": column("antifouling_factor"),
+            "avg_sog": column("spd"),
+            "stay": column("stay_duration"),
+        }
+
+    @classmethod
+    def from_arrays(
+        cls,
+        arrays: tp.Dict[str, np.ndarray],
+        groups: pd.Index,
+        nis: tp.Optional[NIS] = None,
+        trip_count: tp.Optional[int] = None,
+    ) -> "ParameterSweep":
+        # rebuild a prepared sweep from its trip_arrays (MonteCarlo workers)
+        sweep = cls.__new__(cls)
+        sweep.nis = nis if nis is not None else NIS()
+        sweep.group_column = groups.name
+        sweep.groups = groups
+        sweep._trips = dict(arrays)
+        sweep.trip_count = trip_count if trip_count is not None else len(arrays["group_code"])
+        return sweep
+
+    @property
+    def trip_arrays(self) -> tp.Dict[str, np.ndarray]:
+        return self._trips
+
+    @classmethod
+    def from_record_parser(
+        cls,
+        record_parser: RecordParser,
+        nis: tp.Optional[NIS] = None,
+        group_column: str = "d_port_id",
+    ) -> "ParameterSweep":
+        # parse the record file once, keeping only the columns the sweep needs
+        columns = list(dict.fromkeys(SWEEP_COLUMNS + TRIP_SCORE_COLUMNS + [group_column]))
+        tables = []
+        for chunk in record_parser.iter_chunks():
+            trips, _ = record_parser.process_records_batch(chunk)
+            tables.append(trips[columns])
+        trips = pd.concat(tables, ignore_index=True)
+        return cls(trips, record_parser.port_parser, nis, group_column)
+
+    @property
+    def scored_count(self) -> int:
+        # trips left after dropping same-region voyages
+        return len(self._trips["group_code"])
+
+    def parameter_table(
+        self, grid: tp.Union[pd.DataFrame, tp.Sequence[tp.Dict[str, float]]]
+    ) -> pd.DataFrame:
+        # one column per NIS_PARAMETERS entry, the ones missing from grid take self.nis values
+        grid = pd.DataFrame(grid)
+        unknown = [name for name in grid.columns if name not in NIS_PARAMETERS]
+        if unknown:
+            raise ValueError(f"unknown NIS parameters {unknown}")
+        table = pd.DataFrame(index=grid.index)
+        for name, default in self.nis.parameters().items():
+            table[name] = grid[name].astype(float) if name in grid else float(default)
+        return table
+
+    def run(
+        self,
+        grid: tp.Union[pd.DataFrame, tp.Sequence[tp.Dict[str, float]]],
+        block_size: int = SWEEP_BLOCK_SIZE,
+    ) -> pd.DataFrame:
+        # aggregate ballast / biofouling risk of every (parameter set, group)
+        # indexed by (grid index, group_column)
+        table = self.parameter_table(grid)
+        n_trips = self.scored_count
+        trip_block = max(1, min(n_trips, block_size))
+        set_block = max(1, block_size // trip_block)
+        # sum of log(1 - risk) per set and group
+        log_ballast = np.zeros((len(table), len(self.groups)))
+        log_biofouling = np.zeros((len(table), len(self.groups)))
+        for set_start in range(0, len(table), set_block):
+            sets = slice(set_start, set_start + set_block)
+            parameters = {
+                name: table[name].to_numpy()[sets, None] for name in NIS_PARAMETERS
+            }
+            for trip_start in range(0, n_trips, trip_block):
+                trip_slice = slice(trip_start, trip_start + trip_block)
+                p_ballast, p_biofouling = self.evaluate(parameters, trip_slice)
+                self.add_log_survival(log_ballast[sets], p_ballast, trip_slice)
+                self.add_log_survival(log_biofouling[sets], p_biofouling, trip_slice)
+        index = pd.MultiIndex.from_product(
+            [table.index, self.groups], names=[table.index.name or "set", self.group_column]
+        )
+        return pd.DataFrame(
+            {
+                "ballast_risk": risk_from_log_survival(log_ballast).ravel(),
+                "biofouling_risk": risk_from_log_survival(log_biofouling).ravel(),
+            },
+            index=index,
+        )
+
+    def evaluate(
+        self,
+        parameters: tp.Dict[str, np.ndarray],
+        trips: slice,
+        inputs: tp.Optional[tp.Dict[str, np.ndarray]] = None,
+    ) -> tp.Tuple[np.ndarray, np.ndarray]:
+        # NIS batch formulas with (sets, 1) parameters against (trips,) terms
+        # inputs replaces trip terms ("dt", "ds", "ballast_water", ...) by (sets, trips) draws
+        t = {name: values[trips] for name, values in self._trips.items()}
+        if inputs is not None:
+            t.update(inputs)
+        return self.nis.combine_batch(
+            self.nis.establish_factor_batch(t["dt"], t["ds"], t["p_indigenous"], parameters),
+            self.nis.ballast_intro_batch(
+                t["ballast_water"], t["voyage_duration"], parameters=parameters
+            ),
+            self.nis.biofouling_batch(
+                t["abs_lat"], t["anti_p"], t["avg_sog"], t["stay"], parameters
+            ),
+        )
+
+    def add_log_survival(self, total: np.ndarray, risk: np.ndarray, trips: slice) -> None:
+        # total[:, group] += sum of log(1 - risk) over the trips of the group
+        codes = self._trips["group_code"][trips]
+        if len(codes) == 0:
+            return
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        total[:, codes[starts]] += np.add.reduceat(log_survival(risk), starts, axis=1)
+
@@ -1,16 +1,27 @@
 # RecordParser VesselParser PortParser process origin file
 # output VoyageTrip, contains VesselInfo, Desti-PortInfo Origin-PortInfo
+import abc
 import typing as tp
+import os
+import copy
+import csv
+import pickle
+import hashlib
 import attr
 
+from collections import OrderedDict
 from pathlib import Path
 import numpy as np
 import pandas as pd
-import geopandas as gpd
 from datetime import datetime
 from pycountry import countries as pc
 from pycountry.db import Country as pcountry
 
+from instrumentation import PipelineStats, stage
+
+if tp.TYPE_CHECKING:
+    import geopandas as gpd
+
 DATA_DIR = Path(__file__).parent.joinpath("data")
 
 PLACE_DIR = DATA_DIR.joinpath("places.lst")
@@ -21,6 +32,123 @@ MEOW_DIR = Path(__file__).parent.joinpath("MEOW/meow_ecos.shp")
 FEOW_DIR = DATA_DIR.joinpath("FEOW/feow_hydrosheds.shp")
 GIVEN_FILE_DIR = DATA_DIR.joinpath("Places_allportdata_mergedSept2017.csv")
 
+# id used for unparsable / missing PLACE ID and VESSEL ID in batch lookups
+MISSING_ID = -1
+
+# columnar trip table, same order as VoyageTrip.output_to_str
+TRIP_COLUMNS = [
+    "o_port",
+    "o_port_id",
+    "o_port_lat",
+    "o_port_lon",
+    "o_port_country",
+    "d_port",
+    "d_port_id",
+    "d_port_lat",
+    "d_port_lon",
+    "d_port_country",
+    "vessel_id",
+    "vessel_imo",
+    "vessel_type",
+    "vessel_dwt",
+    "arrival_date",
+    "departure_date",
+    "distance",
+    "spd",
+    "voyage_duration",
+    "stay_duration",
+]
+# extra trip table columns used by NIS scoring
+TRIP_SCORE_COLUMNS = [
+    "ballast_discharge",
+    "antifouling_factor",
+    "o_yr_mean_t",
+    "o_salinity",
+    "d_yr_mean_t",
+    "d_salinity",
+    "o_meow_code",
+    "d_meow_code",
+    "o_feow_code",
+    "d_feow_code",
+]
+
+TRIP_RISK_COLUMNS = ["ballast_risk", "biofouling_risk"]
+# scored trip output (no header line)
+TRIP_FILE_COLUMNS = TRIP_COLUMNS + TRIP_RISK_COLUMNS
+
+# rows per block when streaming moves_cleaned_*.txt
+RECORD_CHUNK_SIZE = 200000
+
+# column types of the pipe-delimited files for read_pipe_file
+# "int" is nullable Int64, "datetime" uses DATE_FORMAT, columns not listed stay str
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+PLACE_SCHEMA = {
+    "PLACE ID": "int",
+    "PLACE NAME": "str",
+    "COUNTRY CODE": "category",
+    "LATITUDE DECIMAL": "float",
+    "LONGITUDE DECIMAL": "float",
+}
+VESSEL_SCHEMA = {
+    "VESSEL ID": "int",
+    "IMO": "int",
+    "VESSEL TYPE": "category",
+    "BUILT": "int",
+    "GROSS": "float",
+    "DWT": "float",
+    "LENGTH OVERALL": "float",
+    "BREADTH EXTREME": "float",
+    "DEPTH": "float",
+    "DRAFT": "float",
+}
+RECORD_SCHEMA = {
+    "VESSEL ID": "int",
+    "PLACE ID": "int",
+    "ARRIVAL DATE": "datetime",
+    "SAIL DATE": "datetime",
+    "BALLAST DISCHARGE": "float",
+    "STAY DURATION": "float",
+    "DURATION": "float",
+    "ROUT": "str",
+}
+TRIP_SCHEMA = {
+    "o_port": "category",
+    "o_port_id": "int",
+    "o_port_lat": "float",
+    "o_port_lon": "float",
+    "o_port_country": "category",
+    "d_port": "category",
+    "d_port_id": "int",
+    "d_port_lat": "float",
+    "d_port_lon": "float",
+    "d_port_country": "category",
+    "vessel_id": "int",
+    "vessel_imo": "int",
+    "vessel_type": "category",
+    "vessel_dwt": "float",
+    "arrival_date": "datetime",
+    "departure_date": "datetime",
+    "distance": "float",
+    "spd": "float",
+    "voyage_duration": "float",
+    "stay_duration": "float",
+    "ballast_risk": "float",
+    "biofouling_risk": "float",
+}
+# cells read as missing in numeric / date columns, str columns keep every cell as is
+NA_VALUES = ["", "NA", "N/A", "NaN", "nan", "NaT", "None", "NULL", "null", "<NA>"]
+
+# compiled reference data (port / vessel tables, MEOW attributes), see load_snapshot
+SNAPSHOT_DIR = DATA_DIR.joinpath("snapshot")
+# bump when the content of a snapshot changes shape
+SNAPSHOT_VERSION = 6
+
+# persisted RouteDistanceCache of RecordParser
+ROUTE_DISTANCE_DIR = SNAPSHOT_DIR.joinpath("route_distance.npz")
+
+# upper bound of built PortInfo kept by PortParser, a few thousand distinct ports per run
+PORT_CACHE_SIZE = 8192
+
 TYPE_DICT = {
     "Auto": ["OLC", "PRR", "URC", "URR", "MVE"],
     "Container": ["UBC", "UCC", "UCR"],
@@ -82,6 +210,8 @@ ANTIFOULING_DICT = {
     "Research": 0.63,
     "Yacht": 0.63,
 }
+# antifouling factor of vessel type codes not in TYPE_DICT
+DEFAULT_ANTIFOULING = 0.5
 
 
 def vessel_type_code_antifouling():
@@ -127,7 +257,8 @@ class VoyageTrip:
         self.voyage_avg_sog = None
         self.distance = None
 
-    def check_data(self):
+    def check_data(self, distance: tp.Optional[float] = None):
+        # distance (m) can come from RouteDistanceCache, otherwise computed here
         if not None in (
             self.origin_port,
             self.desti_port,
@@ -137,12 +268,13 @@ class VoyageTrip:
             self.voyage_duration,
         ):
             self.get_data = True
-            distance, _ = ll_to_sa(
-                self.origin_port.port_lat,
-                self.origin_port.port_lon,
-                self.desti_port.port_lat,
-                self.desti_port.port_lon,
-            )  # m
+            if distance is None:
+                distance, _ = ll_to_sa(
+                    self.origin_port.port_lat,
+                    self.origin_port.port_lon,
+                    self.desti_port.port_lat,
+                    self.desti_port.port_lon,
+                )  # m
             self.distance = distance / 1000  # km
             self.voyage_avg_sog = distance / self.voyage_duration  # km / day
 
@@ -154,6 +286,33 @@ class VoyageTrip:
         return output
 
 
+def round_like_scalar(values: pd.Series, ndigits: int) -> pd.Series:
+    # round(value, ndigits) of every value: np.round rounds value * 10**ndigits, which
+    # can land on a tie the exact value is not on; those values are rounded by round()
+    rounded = values.round(ndigits)
+    scaled = values.to_numpy(dtype=float, na_value=np.nan) * 10.0**ndigits
+    with np.errstate(invalid="ignore"):
+        tie = np.abs(scaled - np.floor(scaled) - 0.5) <= 2 * np.spacing(np.abs(scaled))
+    if tie.any():
+        rounded[tie] = [round(float(value), ndigits) for value in values[tie]]
+    return rounded
+
+
+def trips_to_str(trips: pd.DataFrame) -> str:
+    # columnar VoyageTrip.output_to_str: one "|" joined TRIP_FILE_COLUMNS line per trip
+    # missing values (vessel_imo, risks of ports without env data) are empty fields
+    # where VoyageTrip wrote None / nan; vessel_imo is a whole number in every block
+    # dates always carry the time, to_csv drops it from a block of midnight only dates
+    return trips.to_csv(
+        sep="|",
+        header=False,
+        index=False,
+        columns=TRIP_FILE_COLUMNS,
+        lineterminator="\n",
+        date_format=DATE_FORMAT,
+    )
+
+
 class PortInfo:
     def __init__(self, id: int, port_name: str) -> None:
         self.port = port_name
@@ -213,6 +372,8 @@ class PortInfo:
                 meow_neighbour=meow_neighbour,
             )
         if not pd.isna(env_info.iloc[0]["FEOW_region"]):
+            neighbour = env_info.iloc[0].get("FEOW_Neighbors")
+            neighbour = neighbour.split("|") if isinstance(neighbour, str) else []
             feow_neighbour = [n for n in neighbour if n != "NA"]
             self.set_feow(
                 feow_region=env_info.iloc[0]["FEOW_region"],
@@ -264,31 +425,173 @@ class VesselInfo:
 
 
 class PortParser:
-    def __init__(self, port_info_dir: str=PLACE_DIR) -> None:
-        with open(port_info_dir, "r") as f:
-            place_info = f.readlines()
-        labels = place_info[0].strip().split("|")
-        file = [place_info[i].strip().split("|") for i in range(1, len(place_info))]
-        self.place_info = pd.DataFrame(file, columns=labels)
+    def __init__(
+        self,
+        port_info_dir: str = PLACE_DIR,
+        port_cache_size: int = PORT_CACHE_SIZE,
+        use_snapshot: bool = True,
+    ) -> None:
+        source_dirs = [port_info_dir, GIVEN_FILE_DIR, MEOW_DIR, FEOW_DIR]
+        if use_snapshot:
+            tables = load_snapshot(
+                "ports", source_dirs, lambda: self._load_tables(port_info_dir)
+            )
+        else:
+            tables = self._load_tables(port_info_dir)
+        self.port_info_dir = port_info_dir
+        # identifies the source files and snapshot layout, for caches derived from the
+        # port table
+        self.source_signature = f"v{SNAPSHOT_VERSION}|" + "|".join(
+            f"{Path(d).resolve()}:{_file_signature(d)}" for d in source_dirs
+        )
+        self.place_info = tables["place_info"]
+        self.env_file = tables["env_file"]
+        # env rows of places missing from env_file, derived from their ecoregion
+        self.derived_env = tables["derived_env"]
+        # ECOREGION / PROVINCE / REALM of the MEOW shapefile without geometry
+        self.meow_table = tables["meow_table"]
+        # ECOREGION -> REALM / PROVINCE, only ecoregions listed once in the shapefile
+        self.meow_realm: tp.Dict[str, str] = tables["meow_realm"]
+        self.meow_province: tp.Dict[str, str] = tables["meow_province"]
+        self._port_table = tables["port_table"]
+        self._meow_info = None
+
+        # PLACE ID / env ID -> row positions, built once instead of a mask scan per lookup
+        self._place_index = self.place_info.groupby("PLACE ID").indices
+        self._env_index = self.env_file.groupby("ID").indices
+        self._derived_env_index = self.derived_env.groupby("ID").indices
+        # integer region codes of every port for NIS.indigenous_batch
+        port_table = self._port_table
+        self.meow_adjacency = RegionAdjacency(
+            port_table["meow_region"], port_table["meow_neighbours"]
+        )
+        self.feow_adjacency = RegionAdjacency(
+            port_table["feow_region"], port_table["feow_neighbours"]
+        )
+        self._port_table = port_table.assign(
+            meow_code=self.meow_adjacency.encode(
+                port_table["meow_region"], port_table["meow_neighbours"]
+            ),
+            feow_code=self.feow_adjacency.encode(
+                port_table["feow_region"], port_table["feow_neighbours"]
+            ),
+        )
+        # memoized PortInfo (LRU) and pycountry results
+        self.port_cache_size = port_cache_size
+        self._port_cache: "OrderedDict[int, tp.Optional[PortInfo]]" = OrderedDict()
+        self._country_cache: tp.Dict[str, tp.Optional[pcountry]] = dict()
+
+    def _load_tables(self, port_info_dir: str) -> tp.Dict[str, pd.DataFrame]:
+        # parse the source files, this is what a snapshot saves
+        self.place_info = read_pipe_file(port_info_dir, PLACE_SCHEMA)
         self.place_info["PLACE ID"] = self.place_info["PLACE ID"].astype(int)
-        # self.place_info['LATITUDE DECIMAL'] = self.place_info['LATITUDE DECIMAL'].astype(float)
-        # self.place_info['LONGITUDE DECIMAL'] = self.place_info['LONGITUDE DECIMAL'].astype(float)
         self.env_file = pd.read_csv(GIVEN_FILE_DIR)
         self.env_file["ID"] = self.env_file["ID"].astype(int)
-        self.meow_info = gpd.read_file(MEOW_DIR)
-    
+        self.env_file = self._fill_missing_regions()
+        self.derived_env = self._derive_missing_env()
+        import geopandas as gpd
+
+        meow_table = pd.DataFrame(
+            gpd.read_file(MEOW_DIR, ignore_geometry=True)[
+                ["ECOREGION", "PROVINCE", "REALM"]
+            ]
+        )
+        unique_region = meow_table.drop_duplicates("ECOREGION", keep=False)
+        return {
+            "place_info": self.place_info,
+            "env_file": self.env_file,
+            "derived_env": self.derived_env,
+            "meow_table": meow_table,
+            "meow_realm": dict(zip(unique_region["ECOREGION"], unique_region["REALM"])),
+            "meow_province": dict(
+                zip(unique_region["ECOREGION"], unique_region["PROVINCE"])
+            ),
+            "port_table": self._build_port_table(),
+        }
+
+    def _fill_missing_regions(self) -> pd.DataFrame:
+        # env rows without MEOW / FEOW region get the polygon or nearest border region
+        from ecoregions import fill_missing_regions
+
+        return fill_missing_regions(self.env_file, self.place_info, MEOW_DIR, FEOW_DIR)
+
+    def _derive_missing_env(self) -> pd.DataFrame:
+        # one batched point-in-polygon pass over every place without env data
+        from ecoregions import env_from_ecoregions
+
+        places = self.place_info.drop_duplicates("PLACE ID", keep=False)
+        places = places[~places["PLACE ID"].isin(self.env_file["ID"])]
+        derived_env = env_from_ecoregions(places, self.env_file, MEOW_DIR, FEOW_DIR)
+        derived_env["ID"] = derived_env["ID"].astype(int)
+        return derived_env
+
+    @property
+    def meow_info(self) -> "gpd.GeoDataFrame":
+        # MEOW shapefile with geometry, geopandas is only imported when this is used
+        if self._meow_info is None:
+            import geopandas as gpd
+
+            self._meow_info = gpd.read_file(MEOW_DIR)
+        return self._meow_info
+
     def check_meow_region(self, port_id:int) -> str:
         port = self.get_port(int(port_id))
         if port is  None:
             return None
-        Q = self.meow_info[self.meow_info['ECOREGION']==port.meow_region]
-        if len(Q) == 1:
-            return Q.iloc[0]['REALM']
-        return None
+        return self.meow_realm.get(port.meow_region)
+
+    @property
+    def port_table(self) -> pd.DataFrame:
+        # columnar PortInfo of every port get_port can build, indexed by PLACE ID
+        return self._port_table
 
+    def get_ports(self, data_base_ids: tp.Sequence[int]) -> pd.DataFrame:
+        # batch lookup, one row per requested id, unresolved ids give missing rows
+        return self.port_table.reindex(np.asarray(data_base_ids, dtype=np.int64))
+
+    def _build_port_table(self) -> pd.DataFrame:
+        # same resolution rules as get_port: unique PLACE ID, unique env ID, same name
+        places = self.place_info.drop_duplicates("PLACE ID", keep=False)
+        env = self.env_file.drop_duplicates("ID", keep=False)
+        env = pd.concat([env, self.derived_env], ignore_index=True)
+        table = places.merge(env, left_on="PLACE ID", right_on="ID", how="inner")
+        table = table[table["NAME"] == table["PLACE NAME"]]
+        port_lat = table["LATITUDE DECIMAL"].astype(float)
+        port_lon = table["LONGITUDE DECIMAL"].astype(float)
+        no_pos = port_lat.isna() | port_lon.isna()
+        port_table = pd.DataFrame(
+            {
+                "port": table["PLACE NAME"],
+                "port_lat": port_lat.mask(no_pos),
+                "port_lon": port_lon.mask(no_pos),
+                "country_alpha3": table["COUNTRY CODE"].astype(object),
+                "yr_mean_t": table["YR_MEAN_T"].astype(float),
+                "salinity": table["Salinity"].astype(float),
+                "meow_region": table["MEOW_region"],
+                "meow_neighbours": table["MEOW_Neighbors"],
+                "feow_region": table["FEOW_region"],
+                "feow_neighbours": table.get(
+                    "FEOW_Neighbors", pd.Series(np.nan, index=table.index)
+                ),
+            }
+        )
+        port_table.index = pd.Index(table["PLACE ID"].astype(np.int64), name="PLACE ID")
+        return port_table
 
     def get_port(self, data_base_id: int) -> PortInfo:
-        base_info = self.place_info[self.place_info["PLACE ID"] == data_base_id]
+        # PortInfo objects are shared between lookups, treat them as read-only
+        data_base_id = int(data_base_id)
+        if data_base_id in self._port_cache:
+            self._port_cache.move_to_end(data_base_id)
+            return self._port_cache[data_base_id]
+        port = self._build_port(data_base_id)
+        self._port_cache[data_base_id] = port
+        if len(self._port_cache) > self.port_cache_size:
+            self._port_cache.popitem(last=False)
+        return port
+
+    def _build_port(self, data_base_id: int) -> tp.Optional[PortInfo]:
+        base_info = self.place_info.iloc[self._place_index.get(data_base_id, [])]
         if len(base_info) == 0:
             return None
         if len(base_info) > 1:
@@ -298,10 +601,9 @@ class PortParser:
         port = PortInfo(id=data_base_id, port_name=port_name)
 
         country_alpha3 = base_info.iloc[0]["COUNTRY CODE"]
-        try:
-            port_lat = float(base_info.iloc[0]["LATITUDE DECIMAL"])
-            port_lon = float(base_info.iloc[0]["LONGITUDE DECIMAL"])
-        except Exception:
+        port_lat = float(base_info.iloc[0]["LATITUDE DECIMAL"])
+        port_lon = float(base_info.iloc[0]["LONGITUDE DECIMAL"])
+        if np.isnan(port_lat) or np.isnan(port_lon):
             port_lat = np.nan
             port_lon = np.nan
         country_id = None
@@ -318,108 +620,540 @@ class PortParser:
             country_alpha3=country_alpha3,
             country_id=country_id,
         )
-        v = self.env_file[self.env_file["ID"] == data_base_id]
+        v = self.env_file.iloc[self._env_index.get(data_base_id, [])]
         if len(v) == 0:
-            self.env_from_other_source()
+            v = self.env_from_other_source(data_base_id)
         if len(v) > 1:
             raise ValueError("Env file two place ID")
         assert v.iloc[0]["NAME"] == port_name
         port.set_env_info(v)
         return port
 
-    def env_from_other_source(self):
-        return
+    def env_from_other_source(self, data_base_id: int) -> pd.DataFrame:
+        # env rows derived from the MEOW / FEOW polygon the port lies in
+        return self.derived_env.iloc[self._derived_env_index.get(data_base_id, [])]
 
     def get_by_id(self, id: int):
         F = pc.get(numeric=str(id))
         return F
 
     def get_by_alpha3(self, a_code: str):
+        if a_code in self._country_cache:
+            return self._country_cache[a_code]
         try:
             F = pc.get(alpha_3=a_code)
         except Exception:
-            return None
+            F = None
+        self._country_cache[a_code] = F
         return F
 
 
 class VesselParser:
-    def __init__(self, vessel_info_dir: str) -> None:
+    def __init__(self, vessel_info_dir: str, use_snapshot: bool = True) -> None:
 
         self.antifouling_dict = vessel_type_code_antifouling()
-        with open(vessel_info_dir, "r") as f:
-            vessel_info = f.readlines()
-            labels = vessel_info[0].strip().split("|")
-            file = [
-                vessel_info[i].strip().split("|") for i in range(1, len(vessel_info))
-            ]
-            self.vessel_info = pd.DataFrame(file, columns=labels)
-            self.vessel_info["VESSEL ID"] = self.vessel_info["VESSEL ID"].astype(int)
+        if use_snapshot:
+            tables = load_snapshot(
+                "vessels",
+                [vessel_info_dir],
+                lambda: {"vessel_info": self._load_vessel_info(vessel_info_dir)},
+            )
+            self.vessel_info = tables["vessel_info"]
+        else:
+            self.vessel_info = self._load_vessel_info(vessel_info_dir)
+
+        # id index over unique vessels, duplicated ids never resolve
+        duplicated = self.vessel_info["VESSEL ID"].duplicated(keep=False)
+        self._duplicated_ids = set(self.vessel_info.loc[duplicated, "VESSEL ID"])
+        self.vessel_table = self.vessel_info[~duplicated].set_index("VESSEL ID")
+
+    def _load_vessel_info(self, vessel_info_dir: str) -> pd.DataFrame:
+        # parsed once into typed columns, unparsable cells become missing
+        vessel_info = read_pipe_file(vessel_info_dir, VESSEL_SCHEMA)
+        vessel_info["VESSEL ID"] = vessel_info["VESSEL ID"].astype(int)
+        vessel_info["ANTIFOULING"] = (
+            vessel_info["VESSEL TYPE"]
+            .astype(object)
+            .map(self.antifouling_dict)
+            .fillna(DEFAULT_ANTIFOULING)
+        )
+        return vessel_info
 
     def antifouling_factor(self, vessel_type: str) -> float:
         if vessel_type in self.antifouling_dict:
             return self.antifouling_dict[vessel_type]
-        return 0.5
+        return DEFAULT_ANTIFOULING
+
+    def get_vessels(self, vessel_ids: tp.Sequence[int]) -> pd.DataFrame:
+        # batch lookup, one row per requested id in the same order
+        # FOUND is False for unknown or duplicated ids, their other columns are missing
+        vessel_ids = np.asarray(vessel_ids, dtype=np.int64)
+        vessels = self.vessel_table.reindex(vessel_ids)
+        vessels.insert(0, "FOUND", self.vessel_table.index.get_indexer(vessel_ids) >= 0)
+        return vessels
 
     def get_vessel(self, vessel_id: int):
-        vessel_info = self.vessel_info[self.vessel_info["VESSEL ID"] == vessel_id]
-        if len(vessel_info) == 0:
-            return None
-        if len(vessel_info) > 1:
+        if vessel_id in self._duplicated_ids:
             raise ValueError("multi vessel info")
-        vessel_type = vessel_info.iloc[0]["VESSEL TYPE"]
-        anti_f = self.antifouling_factor(vessel_type)
+        if vessel_id not in self.vessel_table.index:
+            return None
+        vessel_info = self.vessel_table.loc[vessel_id]
         vessel_info = VesselInfo(
-            vessel_id=chg_mode(vessel_info.iloc[0]["VESSEL ID"], "int"),
-            imo_number=chg_mode(vessel_info.iloc[0]["IMO"], "int"),
-            vessel_type=vessel_type,
-            antifouling_factor=anti_f,
-            built_year=vessel_info.iloc[0]["BUILT"],
-            gross=chg_mode(vessel_info.iloc[0]["GROSS"], "float"),
-            DWT=chg_mode(vessel_info.iloc[0]["DWT"], "float"),
-            length=chg_mode(
-                vessel_info.iloc[0]["LENGTH OVERALL"],
-                "float",
-            ),
-            breadth=chg_mode(
-                vessel_info.iloc[0]["BREADTH EXTREME"],
-                "float",
-            ),
-            depth=chg_mode(vessel_info.iloc[0]["DEPTH"], "float"),
-            draft=chg_mode(vessel_info.iloc[0]["DRAFT"], "float"),
+            vessel_id=int(vessel_id),
+            imo_number=optional_value(vessel_info.get("IMO"), "int"),
+            vessel_type=optional_value(vessel_info["VESSEL TYPE"], "str"),
+            antifouling_factor=vessel_info["ANTIFOULING"],
+            built_year=optional_value(vessel_info.get("BUILT"), "int"),
+            gross=optional_value(vessel_info.get("GROSS"), "float"),
+            DWT=optional_value(vessel_info.get("DWT"), "float"),
+            length=optional_value(vessel_info.get("LENGTH OVERALL"), "float"),
+            breadth=optional_value(vessel_info.get("BREADTH EXTREME"), "float"),
+            depth=optional_value(vessel_info.get("DEPTH"), "float"),
+            draft=optional_value(vessel_info.get("DRAFT"), "float"),
         )
         return vessel_info
 
 
+def load_snapshot(
+    name: str,
+    source_dirs: tp.Sequence[str],
+    build: tp.Callable[[], tp.Dict[str, tp.Any]],
+    snapshot_dir: str = SNAPSHOT_DIR,
+) -> tp.Dict[str, tp.Any]:
+    # tables built from source_dirs, kept as a pickle in snapshot_dir
+    # the snapshot is rebuilt when any source changes size / mtime or SNAPSHOT_VERSION moves
+    source_dirs = [str(Path(d).resolve()) for d in source_dirs]
+    key = hashlib.sha1("|".join(source_dirs).encode()).hexdigest()[:12]
+    snapshot_file = Path(snapshot_dir).joinpath(f"{name}-{key}.pkl")
+    signature = [_file_signature(d) for d in source_dirs]
+    try:
+        with open(snapshot_file, "rb") as f:
+            snapshot = pickle.load(f)
+        if (
+            snapshot["version"] == SNAPSHOT_VERSION
+            and snapshot["signature"] == signature
+        ):
+            return snapshot["tables"]
+    except Exception:
+        # no snapshot yet, or an unreadable one: rebuild
+        pass
+
+    tables = build()
+    snapshot = {"version": SNAPSHOT_VERSION, "signature": signature, "tables": tables}
+    temp_file = snapshot_file.with_name(f"{snapshot_file.name}.{os.getpid()}.tmp")
+    try:
+        snapshot_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(temp_file, "wb") as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, snapshot_file)
+    except OSError:
+        # read-only data folder, run without a snapshot
+        pass
+    return tables
+
+
+def _file_signature(file_dir: str) -> tp.Optional[tp.Tuple[int, int]]:
+    try:
+        stat = os.stat(file_dir)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
 def chg_mode(value, tg_type):
     try:
         if tg_type == "int":
             return int(value)
+        elif tg_type == "str":
+            return str(value)
         else:
             return float(value)
     except Exception:
         return None
 
 
+def optional_value(value, tg_type):
+    # typed cell -> python scalar, missing -> None as chg_mode does for bad strings
+    if value is None or pd.isna(value):
+        return None
+    return chg_mode(value, tg_type)
+
+
+def typed_column(column: pd.Series, tg_type: str) -> pd.Series:
+    # column -> float64, nullable Int64 (non-integral values missing), category or datetime
+    if tg_type == "category":
+        return column.astype("category")
+    if tg_type == "datetime":
+        dates = pd.to_datetime(column, format=DATE_FORMAT, errors="coerce")
+        retry = dates.isna() & column.notna()
+        if retry.any():
+            dates[retry] = pd.to_datetime(column[retry], errors="coerce")
+        return dates
+    if tg_type == "str":
+        return column
+    values = pd.to_numeric(column, errors="coerce")
+    if tg_type == "int":
+        values = values.where(values == values.round()).astype("Int64")
+    else:
+        values = values.astype(float)
+    return values
+
+
+def read_pipe_file(
+    file_dir: str,
+    schema: tp.Dict[str, str],
+    header: bool = True,
+    chunk_size: tp.Optional[int] = None,
+    skip_rows: int = 0,
+) -> tp.Union[pd.DataFrame, tp.Iterator[pd.DataFrame]]:
+    # load a "|" separated file with the C csv engine and type it with schema
+    # header=False files take the schema keys as column names
+    # chunk_size gives an iterator of blocks whose row index runs on across blocks
+    # skip_rows: first rows left out without being parsed, the index starts at skip_rows
+    if header:
+        with open(file_dir, "r") as f:
+            labels = f.readline().rstrip("\r\n").split("|")
+    else:
+        labels = list(schema)
+    schema = {key: value for key, value in schema.items() if key in labels}
+    # numeric columns are left to the C parser type inference, the rest stay str
+    dtype = {
+        label: str for label in labels if schema.get(label) not in ("int", "float")
+    }
+    na_values = {
+        label: NA_VALUES
+        for label in labels
+        if schema.get(label) in ("int", "float", "datetime")
+    }
+    source = file_dir
+    if skip_rows > 0:
+        source = open(file_dir, "rb")
+        if header:
+            source.readline()
+        _skip_lines(source, skip_rows)
+    reader = pd.read_csv(
+        source,
+        sep="|",
+        engine="c",
+        header=0 if header and skip_rows <= 0 else None,
+        names=labels,
+        dtype=dtype,
+        keep_default_na=False,
+        na_values=na_values,
+        quoting=csv.QUOTE_NONE,
+        float_precision="round_trip",
+        chunksize=chunk_size,
+    )
+    if chunk_size is None:
+        if source is not file_dir:
+            source.close()
+        return _offset_index(_apply_schema(reader, schema), skip_rows)
+    return _typed_blocks(reader, schema, skip_rows, source if source is not file_dir else None)
+
+
+def _typed_blocks(
+    reader, schema: tp.Dict[str, str], skip_rows: int, source: tp.Optional[tp.IO]
+) -> tp.Iterator[pd.DataFrame]:
+    try:
+        for block in reader:
+            yield _offset_index(_apply_schema(block, schema), skip_rows)
+    finally:
+        if source is not None:
+            source.close()
+
+
+def _offset_index(block: pd.DataFrame, skip_rows: int) -> pd.DataFrame:
+    if skip_rows > 0:
+        block.index = block.index + skip_rows
+    return block
+
+
+def _skip_lines(f: tp.BinaryIO, lines: int, block_size: int = 1 << 20) -> None:
+    # move f past its next lines lines, counting newlines a block of bytes at a time
+    while lines > 0:
+        position = f.tell()
+        block = f.read(block_size)
+        if not block:
+            return
+        count = block.count(b"\n")
+        if count < lines:
+            lines -= count
+            continue
+        end = -1
+        for _ in range(lines):
+            end = block.index(b"\n", end + 1)
+        f.seek(position + end + 1)
+        return
+
+
+def _apply_schema(block: pd.DataFrame, schema: tp.Dict[str, str]) -> pd.DataFrame:
+    for column, tg_type in schema.items():
+        block[column] = typed_column(block[column], tg_type)
+    return block
+
+
+class RegionAdjacency:
+    # MEOW or FEOW regions of ports as small integer codes for NIS.indigenous_batch
+    # process_indigenous only reads the neighbours of the two ports of a same region
+    # voyage (0.5 when either port lists that region among its own neighbours), so a
+    # code stands for a (region, port lists its own region) pair
+    def __init__(
+        self,
+        regions: tp.Optional[pd.Series],
+        neighbours: tp.Optional[pd.Series] = None,
+    ) -> None:
+        # regions / neighbours ("|" joined) of every port
+        if regions is None:
+            regions = pd.Series([], dtype=object)
+        pairs = pd.DataFrame(
+            {"region": regions, "listed": self.self_listed(regions, neighbours)}
+        )
+        pairs = pairs[regions.notna()].astype({"region": str}).drop_duplicates()
+        pairs = pairs.sort_values(["region", "listed"])
+        self.regions = np.unique(pairs["region"].to_numpy(dtype=str))
+        self.codes = {
+            (region, listed): code
+            for code, (region, listed) in enumerate(zip(pairs["region"], pairs["listed"]))
+        }
+        # region index / own region listed of every code
+        self.region_of = np.searchsorted(self.regions, pairs["region"].to_numpy(dtype=str))
+        self.listed = pairs["listed"].to_numpy(dtype=bool)
+
+    @staticmethod
+    def self_listed(
+        regions: pd.Series, neighbours: tp.Optional[pd.Series] = None
+    ) -> np.ndarray:
+        # whether each port lists its own region among its neighbours
+        if neighbours is None:
+            return np.zeros(len(regions), dtype=bool)
+        return np.array(
+            [
+                isinstance(region, str)
+                and isinstance(neighbour, str)
+                and region in neighbour.split("|")
+                for region, neighbour in zip(regions, neighbours)
+            ],
+            dtype=bool,
+        )
+
+    def encode(
+        self, regions: pd.Series, neighbours: tp.Optional[pd.Series] = None
+    ) -> np.ndarray:
+        # port region (and neighbours) -> code, missing / unknown regions -> -1
+        listed = self.self_listed(regions, neighbours)
+        return np.array(
+            [
+                self.codes.get((region, is_listed), -1) if isinstance(region, str) else -1
+                for region, is_listed in zip(regions, listed)
+            ],
+            dtype=np.int64,
+        )
+
+
+class PortPairCache(abc.ABC):
+    # values keyed by (origin, destination) PLACE ID pair: sorted keys, one array per
+    # value; the unseen pairs of a lookup are computed together by _compute
+    # cache_dir persists the cache, it is dropped when _cache_signature changes
+    value_names: tp.Tuple[str, ...] = ()
+
+    def __init__(self, cache_dir: tp.Optional[str] = None) -> None:
+        self.cache_dir = cache_dir
+        self._keys = np.empty(0, dtype=np.int64)
+        self._values = [np.empty(0, dtype=float) for _ in self.value_names]
+        # (origin, destination) -> values for the per-trip get
+        self._pairs: tp.Dict[tp.Tuple[int, int], tp.Tuple[float, ...]] = dict()
+        # pairs computed since the last take_added, handed from workers to the parent
+        self._added: tp.List[tp.Tuple[np.ndarray, tp.Sequence[np.ndarray]]] = []
+        self._signature = self._cache_signature()
+        if cache_dir is not None:
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    @staticmethod
+    def pair_key(origin_ids, desti_ids) -> np.ndarray:
+        origin_ids = np.asarray(origin_ids, dtype=np.int64)
+        desti_ids = np.asarray(desti_ids, dtype=np.int64)
+        return (origin_ids << 32) | (desti_ids & 0xFFFFFFFF)
+
+    @staticmethod
+    def split_key(keys: np.ndarray) -> tp.Tuple[np.ndarray, np.ndarray]:
+        return keys >> 32, keys & 0xFFFFFFFF
+
+    def lookup(
+        self, origin_ids: tp.Sequence[int], desti_ids: tp.Sequence[int]
+    ) -> tp.Tuple[np.ndarray, ...]:
+        # one array per value_names entry, aligned with the given pairs
+        keys, inverse = np.unique(
+            self.pair_key(origin_ids, desti_ids), return_inverse=True
+        )
+        positions = np.searchsorted(self._keys, keys)
+        found = positions < len(self._keys)
+        found[found] = self._keys[positions[found]] == keys[found]
+        if not found.all():
+            self._add_pairs(keys[~found])
+            positions = np.searchsorted(self._keys, keys)
+        positions = positions[inverse.ravel()]
+        return tuple(values[positions] for values in self._values)
+
+    def get(self, origin_id: int, desti_id: int) -> tp.Tuple[float, ...]:
+        pair = (int(origin_id), int(desti_id))
+        if pair not in self._pairs:
+            values = self.lookup([origin_id], [desti_id])
+            self._pairs[pair] = tuple(float(v[0]) for v in values)
+        return self._pairs[pair]
+
+    @abc.abstractmethod
+    def _compute(self, keys: np.ndarray) -> tp.Sequence[np.ndarray]:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def _cache_signature(self) -> str:
+        raise NotImplementedError()
+
+    def _add_pairs(self, keys: np.ndarray) -> None:
+        values = self._compute(keys)
+        self._added.append((keys, values))
+        self._insert(keys, values)
+
+    def _insert(self, keys: np.ndarray, values: tp.Sequence[np.ndarray]) -> None:
+        keys = np.concatenate([self._keys, keys])
+        order = np.argsort(keys, kind="stable")
+        self._keys = keys[order]
+        self._values = [
+            np.concatenate([old, np.asarray(new, dtype=float)])[order]
+            for old, new in zip(self._values, values)
+        ]
+
+    def take_added(self) -> tp.Tuple[np.ndarray, tp.List[np.ndarray]]:
+        # keys / values computed since the last call
+        keys = np.concatenate([self._keys[:0]] + [keys for keys, _ in self._added])
+        values = [
+            np.concatenate([old[:0]] + [np.asarray(new[i], dtype=float) for _, new in self._added])
+            for i, old in enumerate(self._values)
+        ]
+        self._added = []
+        return keys, values
+
+    def merge(self, keys: np.ndarray, values: tp.Sequence[np.ndarray]) -> None:
+        # add pairs computed by another cache (take_added of a worker)
+        keys, first = np.unique(keys, return_index=True)
+        positions = np.searchsorted(self._keys, keys)
+        found = positions < len(self._keys)
+        found[found] = self._keys[positions[found]] == keys[found]
+        if not found.all():
+            new = first[~found]
+            self._insert(keys[~found], [np.asarray(v)[new] for v in values])
+
+    def _load(self) -> None:
+        try:
+            with np.load(self.cache_dir) as cache:
+                if str(cache["signature"]) != self._signature:
+                    return
+                self._keys = cache["keys"]
+                self._values = [cache[name] for name in self.value_names]
+        except Exception:
+            # no cache yet, or an unreadable one: start empty
+            return
+
+    def save(self) -> None:
+        if self.cache_dir is None:
+            return
+        cache_dir = Path(self.cache_dir)
+        temp_file = cache_dir.with_name(f"{cache_dir.name}.{os.getpid()}.tmp")
+        values = dict(zip(self.value_names, self._values))
+        try:
+            cache_dir.parent.mkdir(parents=True, exist_ok=True)
+            with open(temp_file, "wb") as f:
+                np.savez(
+                    f, signature=np.array(self._signature), keys=self._keys, **values
+                )
+            os.replace(temp_file, cache_dir)
+        except OSError:
+            pass
+
+
+class RouteDistanceCache(PortPairCache):
+    # distance (m) and bearing (deg) of origin -> destination port id pairs
+    # filled with one vectorized ll_to_sa over the unseen pairs of each lookup
+    value_names = ("distance", "bearing")
+
+    def __init__(
+        self, port_parser: PortParser, cache_dir: tp.Optional[str] = None
+    ) -> None:
+        self.port_parser = port_parser
+        super().__init__(cache_dir)
+
+    def _compute(self, keys: np.ndarray) -> tp.Sequence[np.ndarray]:
+        origin_ids, desti_ids = self.split_key(keys)
+        origin = self.port_parser.get_ports(origin_ids)
+        desti = self.port_parser.get_ports(desti_ids)
+        return ll_to_sa(
+            origin["port_lat"].to_numpy(),
+            origin["port_lon"].to_numpy(),
+            desti["port_lat"].to_numpy(),
+            desti["port_lon"].to_numpy(),
+        )
+
+    def _cache_signature(self) -> str:
+        # port positions come from the place file, a new file invalidates the cache
+        port_info_dir = str(Path(self.port_parser.port_info_dir).resolve())
+        return f"{port_info_dir}|{_file_signature(port_info_dir)}"
+
+
 class RecordParser:
     def __init__(
         self,
         record_dir: str,
         vessel_info_dir: str,
         port_info_dir: str,
+        chunk_size: int = RECORD_CHUNK_SIZE,
+        distance_cache_dir: tp.Optional[str] = ROUTE_DISTANCE_DIR,
+        stats: tp.Optional[PipelineStats] = None,
     ) -> None:
-        self._read_init_file(record_dir)
+        # records are streamed by iter_chunks, self.record only loads on demand
+        # stats times the port / vessel / distance stages of process_records_batch
+        self.record_dir = record_dir
+        self.stats = stats
+        self.chunk_size = chunk_size
+        self._record = None
 
         self.record_name = f"record-{record_dir}"
         self.vessel_parser = VesselParser(vessel_info_dir)
         self.port_parser = PortParser(port_info_dir)
+        # shared by process_one_record and process_records_batch, save() persists it
+        self.distance_cache = RouteDistanceCache(self.port_parser, distance_cache_dir)
+
+    @property
+    def record(self) -> pd.DataFrame:
+        # whole record file in memory, prefer iter_chunks for long files
+        if self._record is None:
+            self._read_init_file(self.record_dir)
+        return self._record
 
     def _read_init_file(self, record_dir: str) -> None:
-        with open(record_dir, "r") as f:
-            sv_15 = f.readlines()
-        labels = sv_15[0].strip().split("|")
-        file = [sv_15[i].strip().split("|") for i in range(1, len(sv_15))]
-        sv_15 = pd.DataFrame(file, columns=labels)
-        self.record = sv_15
+        self._record = pd.concat(read_record_chunks(record_dir, self.chunk_size))
+
+    def with_record(self, record_dir: str) -> "RecordParser":
+        # parser of another record file sharing the vessel / port parsers and caches
+        other = copy.copy(self)
+        other.record_dir = record_dir
+        other.record_name = f"record-{record_dir}"
+        other._record = None
+        return other
+
+    def iter_chunks(
+        self, chunk_size: tp.Optional[int] = None, start_row: int = 0
+    ) -> tp.Iterator[pd.DataFrame]:
+        # blocks of the record rows from start_row on
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        if self._record is not None:
+            for start in range(start_row, max(len(self._record), start_row + 1), chunk_size):
+                yield self._record.iloc[start : start + chunk_size]
+            return
+        yield from read_record_chunks(self.record_dir, chunk_size, start_row)
 
     def process_one_record(self, one_record: pd.Series) -> tp.Optional[VoyageTrip]:
         vessel_id = int(one_record["VESSEL ID"])
@@ -452,13 +1186,132 @@ class RecordParser:
         one_trip.voyage_duration = voyage_duration
         one_trip.vessel_departure_from_desti_date = sail_date_str
         one_trip.vessel_arrival_desti_date = arrival_date_str
-        one_trip.check_data()
+        distance, _ = self.distance_cache.get(route[0], route[1])
+        one_trip.check_data(distance)
         return one_trip
 
+    def process_records_batch(
+        self, records: tp.Optional[pd.DataFrame] = None
+    ) -> tp.Tuple[pd.DataFrame, pd.Series]:
+        # columnar counterpart of process_one_record over a whole record frame (or chunk)
+        # return trip table (TRIP_COLUMNS + TRIP_SCORE_COLUMNS) of the valid rows and
+        # error message of the other rows, both indexed by the record row index
+        if records is None:
+            records = self.record
+        vessel_id = pd.to_numeric(records["VESSEL ID"], errors="coerce")
+        place_id = pd.to_numeric(records["PLACE ID"], errors="coerce")
+        ballast = round_like_scalar(
+            pd.to_numeric(records["BALLAST DISCHARGE"], errors="coerce"), 4
+        )
+        stay_duration = pd.to_numeric(records["STAY DURATION"], errors="coerce")
+        voyage_duration = pd.to_numeric(records["DURATION"], errors="coerce")
+        route = records["ROUT"].astype("string").str.extract(r"^\s*(\d+)-(\d+)")
+        origin_id = pd.to_numeric(route[0], errors="coerce")
+        desti_id = pd.to_numeric(route[1], errors="coerce")
+
+        with stage(self.stats, "vessel"):
+            vessels = self.vessel_parser.get_vessels(_ids(vessel_id))
+        with stage(self.stats, "port"):
+            origin = self.port_parser.get_ports(_ids(origin_id))
+            desti = self.port_parser.get_ports(_ids(desti_id))
+
+        error = np.select(
+            [
+                vessel_id.isna().to_numpy() | place_id.isna().to_numpy(),
+                ballast.isna().to_numpy()
+                | stay_duration.isna().to_numpy()
+                | voyage_duration.isna().to_numpy(),
+                origin_id.isna().to_numpy() | desti_id.isna().to_numpy(),
+                _ids(desti_id) != _ids(place_id),
+                ~vessels["FOUND"].to_numpy(),
+                origin["port"].isna().to_numpy(),
+                desti["port"].isna().to_numpy(),
+            ],
+            [
+                "invalid VESSEL ID or PLACE ID",
+                "invalid ballast or duration",
+                "no route",
+                "route does not end at PLACE ID",
+                "vessel not found",
+                "origin port not found",
+                "destination port not found",
+            ],
+            default="",
+        )
+        valid = error == ""
+
+        with stage(self.stats, "distance"):
+            distance, _ = self.distance_cache.lookup(
+                _ids(origin_id), _ids(desti_id)
+            )  # m
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # m / day, same as VoyageTrip.check_data
+            voyage_avg_sog = distance / voyage_duration.to_numpy()
+
+        trips = pd.DataFrame(
+            {
+                "o_port": origin["port"].to_numpy(),
+                "o_port_id": _ids(origin_id),
+                "o_port_lat": origin["port_lat"].to_numpy(),
+                "o_port_lon": origin["port_lon"].to_numpy(),
+                "o_port_country": origin["country_alpha3"].to_numpy(),
+                "d_port": desti["port"].to_numpy(),
+                "d_port_id": _ids(desti_id),
+                "d_port_lat": desti["port_lat"].to_numpy(),
+                "d_port_lon": desti["port_lon"].to_numpy(),
+                "d_port_country": desti["country_alpha3"].to_numpy(),
+                "vessel_id": _ids(vessel_id),
+                "vessel_imo": pd.array(vessels["IMO"], dtype="Int64"),
+                "vessel_type": vessels["VESSEL TYPE"].to_numpy(),
+                "vessel_dwt": vessels["DWT"].to_numpy(),
+                "arrival_date": records["ARRIVAL DATE"].to_numpy(),
+                "departure_date": records["SAIL DATE"].to_numpy(),
+                "distance": distance / 1000,  # km
+                "spd": voyage_avg_sog,
+                "voyage_duration": voyage_duration.to_numpy(),
+                "stay_duration": stay_duration.to_numpy(),
+                "ballast_discharge": ballast.to_numpy(),
+                "antifouling_factor": vessels["ANTIFOULING"].to_numpy(),
+                "o_yr_mean_t": origin["yr_mean_t"].to_numpy(),
+                "o_salinity": origin["salinity"].to_numpy(),
+                "d_yr_mean_t": desti["yr_mean_t"].to_numpy(),
+                "d_salinity": desti["salinity"].to_numpy(),
+                "o_meow_code": _ids(origin["meow_code"]),
+                "d_meow_code": _ids(desti["meow_code"]),
+                "o_feow_code": _ids(origin["feow_code"]),
+                "d_feow_code": _ids(desti["feow_code"]),
+            },
+            index=records.index,
+        )
+        errors = pd.Series(error[~valid], index=records.index[~valid], dtype=object)
+        return trips[valid], errors
+
     def iter_rows(self):
-        for (
-            row_idth,
-            one_record,
-        ) in self.record.iterrows():
+        for chunk in self.iter_chunks():
+            for (
+                row_idth,
+                one_record,
+            ) in chunk.iterrows():
+
+                yield row_idth, one_record
+
+
+def read_record_chunks(
+    record_dir: str, chunk_size: int = RECORD_CHUNK_SIZE, start_row: int = 0
+) -> tp.Iterator[pd.DataFrame]:
+    # stream a moves_cleaned_*.txt file as typed blocks of at most chunk_size rows
+    # row index runs on across blocks, an empty file gives one empty block
+    # start_row: rows before it are skipped unparsed (a --resume)
+    empty = True
+    for block in read_pipe_file(
+        record_dir, RECORD_SCHEMA, chunk_size=chunk_size, skip_rows=start_row
+    ):
+        empty = False
+        yield block
+    if empty:
+        yield read_pipe_file(record_dir, RECORD_SCHEMA)
+
 
-            yield row_idth, one_record
+def _ids(values: pd.Series) -> np.ndarray:
+    # numeric id column -> int64 array, missing ids -> MISSING_ID
+    return values.fillna(MISSING_ID).to_numpy(dtype=np.int64)
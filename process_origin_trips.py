@@ -1,13 +1,45 @@
 # process origin trip file
 # output trip records with NIO probability as well as error info
+# python process_origin_trips.py [--workers N] [--chunk-size ROWS] [...]
+# the record file is cut into shards of chunk-size rows, scored on a process pool
+# and written back in row order
+# after every --checkpoint-every shards the outputs are fsynced and their sizes saved
+# with the next record row in <output>.checkpoint; --resume cuts the outputs back to
+# the last checkpoint and carries on from that row
+# stage times, rows/s and error rate are reported every --report-interval seconds and
+# saved as json in --stats-json (<output>.stats.json)
+# several --record files (or globs) share the loaded parsers and the process pool,
+# each one is written to <output-dir>/trip_record_<year>.txt (+ error file) and listed
+# in the --index json
+# --format parquet writes the trips as a parquet store (trip_store.py) in place of the
+# text file: <output> with a .parquet suffix, partitioned by year, sorted by destination port
+# and checkpointed only when the writer flushes (PARQUET_FLUSH_ROWS trips)
+# --incremental only scores the rows that are new or changed since the last
+# --incremental run of the same output (incremental.py) and patches the outputs
+# shards and checkpoints are written by a background thread (ShardWriter) fed through
+# a bounded queue, so scoring only waits for the disk when the queue is full
 
 
 
+import argparse
+import contextlib
+import glob
+import json
+import re
+import os
+import queue
+import threading
+import typing as tp
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from datetime import datetime
 
-from parsers import RecordParser
-from nis_probability import NIS
+import pandas as pd
+
+from instrumentation import REPORT_INTERVAL, PipelineStats
+from parsers import RECORD_CHUNK_SIZE, TRIP_FILE_COLUMNS, RecordParser, trips_to_str
+from nis_probability import NIS, EstablishmentCache, ESTABLISH_CACHE_DIR
 
 # data files address
 DATA_DIR = Path(__file__).parent.joinpath("data")
@@ -20,30 +52,609 @@ record_dir = DATA_DIR.joinpath('moves_cleaned_2015.txt')
 # record output
 TRIP_RECORD_DIR = DATA_DIR.joinpath('trip_record.txt')
 # record process error
-TRIP_ERROR_RECORD_DIR = DATA_DIR.joinpath('trip_record_error.txt') 
+TRIP_ERROR_RECORD_DIR = DATA_DIR.joinpath('trip_record_error.txt')
+
+# shards scored ahead of the writer per worker, bounds the memory of a run
+SHARDS_IN_FLIGHT = 2
+# shards written between two checkpoints
+CHECKPOINT_EVERY = 1
+# outputs of a run over several record files
+TRIP_RECORD_INDEX_DIR = DATA_DIR.joinpath('trip_record_index.json')
+# trip output formats: "|" joined text lines or a parquet store
+OUTPUT_FORMATS = ("text", "parquet")
+# shards waiting for the writer thread, bounds the memory held up by a slow disk
+WRITE_QUEUE_SIZE = 4
+# buffer of the text output files in bytes
+WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+
 
-record_parser = RecordParser(record_dir = record_dir, vessel_info_dir=vessel_dir, port_info_dir=place_dir)
-nis = NIS() # Nonindigenous invasion calculation
+class ScoredShard(tp.NamedTuple):
+    # trip_text of the text format, trip_table (TRIP_FILE_COLUMNS) of the parquet one
+    trip_text: str
+    trip_table: tp.Optional[pd.DataFrame]
+    error_text: str
+    # last record row index, None for an empty shard
+    last_row: tp.Optional[int]
+    rows: int
+    errors: int
 
-trip_record = open(TRIP_RECORD_DIR,'w')
-error_record = open(TRIP_ERROR_RECORD_DIR,'w')
 
-try:
-    for row_idth, one_record in record_parser.iter_rows():
-        print(row_idth)
+class TripScorer:
+    # reference data (ports, vessels, caches) of one process, built once
+    def __init__(
+        self,
+        record_dir: str,
+        vessel_dir: str,
+        place_dir: str,
+        stats: tp.Optional[PipelineStats] = None,
+        output_format: str = "text",
+    ) -> None:
+        self.paths = (record_dir, vessel_dir, place_dir)
+        self.output_format = output_format
+        self.stats = stats if stats is not None else PipelineStats()
+        self.record_parser = RecordParser(
+            record_dir=record_dir,
+            vessel_info_dir=vessel_dir,
+            port_info_dir=place_dir,
+            stats=self.stats,
+        )
+        self.nis = NIS() # Nonindigenous invasion calculation
+        # p_indigenous * p_establish per port pair, kept across runs
+        self.establish_cache = EstablishmentCache(
+            self.nis, self.record_parser.port_parser, ESTABLISH_CACHE_DIR
+        )
+
+    def _score_table(self, chunk: pd.DataFrame) -> tp.Tuple[pd.DataFrame, pd.Series, str]:
         now = str(datetime.now())[:19]
-        try: 
-            one_trip = record_parser.process_one_record(one_record)
-            ballast_probability, biofouling_probability = nis.calculate_by_voyage(one_trip)
-            trip_info = one_trip.output_to_str()
-            s = f'{trip_info.strip()}|{ballast_probability}|{biofouling_probability}\n'
-            trip_record.write(s)
-        except Exception as e:
-            error_record.write(f'{row_idth}|{e}|{now}\n')
-finally:
-    error_record.close()
-    trip_record.close()
-    
+        trips, errors = self.record_parser.process_records_batch(chunk)
+        with self.stats.stage("score"):
+            trips = self.nis.calculate_trip_table(
+                trips, self.record_parser.port_parser, self.establish_cache
+            )
+        return trips, errors, now
+
+    def score_rows(self, chunk: pd.DataFrame) -> tp.Tuple[pd.Series, pd.Series]:
+        # trip line of every valid row and error line of the others, by record row
+        trips, errors, now = self._score_table(chunk)
+        with self.stats.stage("format"):
+            trip_lines = [f"{line}\n" for line in trips_to_str(trips).split("\n")[:-1]]
+            error_lines = [f'{row_idth}|{e}|{now}\n' for row_idth, e in errors.items()]
+        return (
+            pd.Series(trip_lines, index=trips.index, dtype=object),
+            pd.Series(error_lines, index=errors.index, dtype=object),
+        )
+
+    def score(self, chunk: pd.DataFrame) -> ScoredShard:
+        # trip lines and error lines of a record block
+        trips, errors, now = self._score_table(chunk)
+        with self.stats.stage("format"):
+            if self.output_format == "parquet":
+                trip_text, trip_table = "", trips[TRIP_FILE_COLUMNS]
+            else:
+                trip_text, trip_table = trips_to_str(trips), None
+            error_text = "".join(
+                f'{row_idth}|{e}|{now}\n' for row_idth, e in errors.items()
+            )
+        last_row = chunk.index[-1] if len(chunk) else None
+        return ScoredShard(
+            trip_text, trip_table, error_text, last_row, len(chunk), len(errors)
+        )
+
+    def save_caches(self) -> None:
+        self.record_parser.distance_cache.save()
+        self.establish_cache.save()
+
+
+# TripScorer of a pool worker, inherited from the parent under fork
+_SCORER: tp.Dict[str, TripScorer] = dict()
+
+
+def _init_worker(
+    record_dir: str, vessel_dir: str, place_dir: str, output_format: str
+) -> None:
+    # spawn / forkserver workers rebuild it from the parser snapshots
+    if "scorer" not in _SCORER:
+        _SCORER["scorer"] = TripScorer(
+            record_dir, vessel_dir, place_dir, output_format=output_format
+        )
+    # forked workers start from a copy of the parent counters
+    _SCORER["scorer"].stats.take_stages()
+
+
+def _score_shard(chunk: pd.DataFrame, rows: bool = False):
+    # the port pairs a worker computed and its stage times go back to the parent
+    # rows: score_rows (line per record row) in place of score
+    scorer = _SCORER["scorer"]
+    result = scorer.score_rows(chunk) if rows else scorer.score(chunk)
+    added = (
+        scorer.record_parser.distance_cache.take_added(),
+        scorer.establish_cache.take_added(),
+    )
+    return result, added, scorer.stats.take_stages()
+
+
+@contextlib.contextmanager
+def scoring_pool(
+    scorer: TripScorer, workers: int
+) -> tp.Iterator[tp.Optional[ProcessPoolExecutor]]:
+    # process pool over the reference data of scorer, None to score in this process
+    if workers <= 1:
+        yield None
+        return
+    _SCORER["scorer"] = scorer
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(*scorer.paths, scorer.output_format),
+    ) as executor:
+        # the first task starts every forked worker, done here while this process has
+        # a single thread: forking next to the ShardWriter thread can deadlock a worker
+        executor.submit(_worker_ready).result()
+        yield executor
+
+
+def _worker_ready() -> bool:
+    return "scorer" in _SCORER
+
+
+def iter_scored(
+    scorer: TripScorer,
+    executor: tp.Optional[ProcessPoolExecutor],
+    record_dir: str,
+    chunk_size: int,
+    start_row: int = 0,
+    in_flight_limit: int = SHARDS_IN_FLIGHT,
+) -> tp.Iterator[ScoredShard]:
+    # scored shards of record_dir in row order, from record row start_row on
+    # at most in_flight_limit shards are submitted ahead of the consumer
+    record_parser = scorer.record_parser.with_record(record_dir)
+    chunks = _timed_chunks(record_parser.iter_chunks(chunk_size, start_row), scorer.stats)
+    if executor is None:
+        for chunk in chunks:
+            yield scorer.score(chunk)
+        return
+    in_flight = deque()
+    for chunk in chunks:
+        in_flight.append(executor.submit(_score_shard, chunk))
+        while len(in_flight) >= in_flight_limit:
+            yield _merge_shard(scorer, in_flight.popleft())
+    while in_flight:
+        yield _merge_shard(scorer, in_flight.popleft())
+
+
+def iter_scored_rows(
+    scorer: TripScorer,
+    executor: tp.Optional[ProcessPoolExecutor],
+    chunks: tp.Iterable[tp.Tuple[tp.Any, pd.DataFrame]],
+    in_flight_limit: int = SHARDS_IN_FLIGHT,
+) -> tp.Iterator[tp.Tuple[tp.Any, tp.Tuple[pd.Series, pd.Series]]]:
+    # score_rows of every (key, chunk) in order as (key, (trip_lines, error_lines)),
+    # on the pool like iter_scored; empty chunks are not scored
+    empty = (pd.Series(dtype=object), pd.Series(dtype=object))
+    if executor is None:
+        for key, chunk in chunks:
+            yield key, scorer.score_rows(chunk) if len(chunk) else empty
+        return
+    in_flight = deque()
+    for key, chunk in chunks:
+        future = executor.submit(_score_shard, chunk, True) if len(chunk) else None
+        in_flight.append((key, future))
+        while len(in_flight) >= in_flight_limit:
+            key, future = in_flight.popleft()
+            yield key, _merge_shard(scorer, future) if future is not None else empty
+    while in_flight:
+        key, future = in_flight.popleft()
+        yield key, _merge_shard(scorer, future) if future is not None else empty
+
+
+def _timed_chunks(
+    chunks: tp.Iterator[pd.DataFrame], stats: PipelineStats
+) -> tp.Iterator[pd.DataFrame]:
+    while True:
+        with stats.stage("read"):
+            chunk = next(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+def _merge_shard(scorer: TripScorer, future) -> ScoredShard:
+    with scorer.stats.stage("wait"):
+        result, (distance_added, establish_added), stages = future.result()
+    scorer.record_parser.distance_cache.merge(*distance_added)
+    scorer.establish_cache.merge(*establish_added)
+    scorer.stats.merge_stages(stages)
+    return result
+
+
+class Checkpoint:
+    # next record row and committed output sizes of a run, as <output>.checkpoint json
+    def __init__(self, record_dir: str, output_dir: str, error_dir: str) -> None:
+        self.record_dir = str(record_dir)
+        self.output_dir = str(output_dir)
+        self.error_dir = str(error_dir)
+        self.checkpoint_dir = Path(f"{output_dir}.checkpoint")
+
+    def _record_signature(self) -> tp.List[int]:
+        stat = os.stat(self.record_dir)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def load(self) -> tp.Optional[tp.Dict[str, tp.Any]]:
+        # last checkpoint of the same record file, None when there is none
+        try:
+            with open(self.checkpoint_dir) as f:
+                checkpoint = json.load(f)
+        except FileNotFoundError:
+            return None
+        if checkpoint["record"] != str(Path(self.record_dir).resolve()):
+            raise ValueError(f"checkpoint of another record file {checkpoint['record']}")
+        if checkpoint["record_signature"] != self._record_signature():
+            raise ValueError("record file changed since the checkpoint")
+        return checkpoint
+
+    def save(
+        self, state: tp.Dict[str, tp.Any], trip_output: "TripOutput", error_record: tp.IO
+    ) -> None:
+        # state: next_row / rows / error_rows / complete of the run
+        # outputs reach the disk before the checkpoint that counts them
+        sizes = [trip_output.commit(), commit_file(error_record)]
+        checkpoint = {
+            "record": str(Path(self.record_dir).resolve()),
+            "record_signature": self._record_signature(),
+            **state,
+            "output_size": sizes[0],
+            "error_size": sizes[1],
+        }
+        temp_file = self.checkpoint_dir.with_name(f"{self.checkpoint_dir.name}.tmp")
+        with open(temp_file, "w") as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, self.checkpoint_dir)
+
+    def remove(self) -> None:
+        try:
+            os.remove(self.checkpoint_dir)
+        except FileNotFoundError:
+            pass
+
+
+def commit_file(f: tp.IO) -> int:
+    # flush and fsync f, return its size
+    f.flush()
+    os.fsync(f.fileno())
+    return os.fstat(f.fileno()).st_size
+
+
+class TextTripOutput:
+    # trips_to_str lines, committed size in bytes
+    def __init__(self, output_dir: str, size: tp.Optional[int] = None) -> None:
+        if size is None:
+            self.file = open(output_dir, 'w', buffering=WRITE_BUFFER_SIZE)
+        else:
+            os.truncate(output_dir, size)
+            self.file = open(output_dir, 'a', buffering=WRITE_BUFFER_SIZE)
+
+    def write(self, shard: ScoredShard) -> None:
+        self.file.write(shard.trip_text)
+
+    def ready(self) -> bool:
+        # a checkpoint can be taken after any shard
+        return True
+
+    def commit(self) -> int:
+        return commit_file(self.file)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class ParquetTripOutput:
+    # parquet store, committed size in ParquetTripWriter parts
+    def __init__(self, output_dir: str, size: tp.Optional[int] = None) -> None:
+        from trip_store import ParquetTripWriter
+
+        self.writer = ParquetTripWriter(output_dir)
+        self.writer.truncate(size or 0)
+
+    def write(self, shard: ScoredShard) -> None:
+        self.writer.write(shard.trip_table)
+
+    def ready(self) -> bool:
+        # checkpoints wait for the writer to flush PARQUET_FLUSH_ROWS trips, committing
+        # every shard would write one small file per year and shard
+        return self.writer.buffered_rows == 0
+
+    def commit(self) -> int:
+        return self.writer.flush()
+
+    def close(self) -> None:
+        # trips written after the last commit are scored again by --resume
+        pass
+
+
+TripOutput = tp.Union[TextTripOutput, ParquetTripOutput]
+
+
+def open_outputs(
+    checkpoint: Checkpoint, resume: bool, output_format: str = "text"
+) -> tp.Tuple[TripOutput, tp.IO, tp.Dict[str, tp.Any]]:
+    # trip / error output and run state (next_row first record row to score)
+    # resume cuts both outputs back to the checkpoint sizes, rows written after it are redone
+    trip_output = ParquetTripOutput if output_format == "parquet" else TextTripOutput
+    saved = checkpoint.load() if resume else None
+    if saved is None:
+        checkpoint.remove()
+        state = {"next_row": 0, "rows": 0, "error_rows": 0, "complete": False}
+        error_record = open(checkpoint.error_dir, 'w', buffering=WRITE_BUFFER_SIZE)
+        return trip_output(checkpoint.output_dir), error_record, state
+    trip_record = trip_output(checkpoint.output_dir, saved["output_size"])
+    os.truncate(checkpoint.error_dir, saved["error_size"])
+    error_record = open(checkpoint.error_dir, 'a', buffering=WRITE_BUFFER_SIZE)
+    state = {
+        name: saved.get(name, 0)
+        for name in ["next_row", "rows", "error_rows", "complete"]
+    }
+    return trip_record, error_record, state
+
+
+class ShardWriter:
+    # writes shards to the outputs and saves checkpoints on a background thread, in
+    # the order they were put; put() blocks only while queue_size shards are waiting
+    # a failure of the thread is raised by the next put() or close()
+    def __init__(
+        self,
+        trip_output: TripOutput,
+        error_record: tp.IO,
+        checkpoint: Checkpoint,
+        stats: PipelineStats,
+        queue_size: int = WRITE_QUEUE_SIZE,
+    ) -> None:
+        self.trip_output = trip_output
+        self.error_record = error_record
+        self.checkpoint = checkpoint
+        self.stats = stats
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error: tp.Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, name="trip-writer")
+        self._thread.start()
+
+    def put(
+        self, shard: tp.Optional[ScoredShard], state: tp.Optional[tp.Dict[str, tp.Any]] = None
+    ) -> None:
+        # state: run state checkpointed once shard (None: nothing) is on disk, skipped
+        # until the trip output is ready() unless the run is complete
+        self._raise()
+        with self.stats.stage("queue"):
+            self._queue.put((shard, dict(state) if state is not None else None))
+
+    def close(self) -> None:
+        # write what is queued, stop the thread and close the outputs
+        try:
+            self._queue.put(None)
+            self._thread.join()
+            self._raise()
+        finally:
+            self.error_record.close()
+            self.trip_output.close()
+
+    def _raise(self) -> None:
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                # keep draining so that put() never waits on a dead writer
+                continue
+            shard, state = item
+            try:
+                with self.stats.stage("write"):
+                    if shard is not None:
+                        self.trip_output.write(shard)
+                        self.error_record.write(shard.error_text)
+                    if state is not None and (state["complete"] or self.trip_output.ready()):
+                        self.checkpoint.save(state, self.trip_output, self.error_record)
+            except BaseException as e:
+                self._error = e
+
+
+class RecordJob(tp.NamedTuple):
+    record: str
+    output: str
+    errors: str
+
+
+def record_jobs(
+    records: tp.Sequence[str],
+    output: str,
+    errors: str,
+    output_dir: str,
+    output_format: str = "text",
+) -> tp.List[RecordJob]:
+    # record files of the --record paths / globs with their outputs
+    # one file keeps output / errors, several get trip_record_<year>.txt in output_dir
+    # a parquet output takes the .parquet suffix
+    suffix = ".parquet" if output_format == "parquet" else ".txt"
+    files = []
+    for pattern in records:
+        files.extend(sorted(glob.glob(pattern)) or [pattern])
+    if len(files) == 1:
+        if output_format == "parquet":
+            output = str(Path(output).with_suffix(suffix))
+        return [RecordJob(files[0], output, errors)]
+    jobs = []
+    for record in files:
+        label = _record_label(record)
+        jobs.append(
+            RecordJob(
+                record,
+                str(Path(output_dir).joinpath(f"trip_record_{label}{suffix}")),
+                str(Path(output_dir).joinpath(f"trip_record_error_{label}.txt")),
+            )
+        )
+    labels = [job.output for job in jobs]
+    if len(set(labels)) != len(labels):
+        raise ValueError("two record files with the same year")
+    return jobs
+
+
+def _record_label(record: str) -> str:
+    # year of moves_cleaned_<year>.txt, the file name otherwise
+    years = re.findall(r"\d{4}", Path(record).stem)
+    return years[-1] if years else Path(record).stem
+
+
+def run_job(
+    scorer: TripScorer,
+    executor: tp.Optional[ProcessPoolExecutor],
+    job: RecordJob,
+    args: argparse.Namespace,
+) -> tp.Dict[str, tp.Any]:
+    # score one record file into its outputs, return its index entry
+    # a file completed before a --resume is not read again
+    if args.incremental:
+        from incremental import refresh
+
+        in_flight_limit = max(args.workers, 1) * SHARDS_IN_FLIGHT
+        delta = refresh(
+            scorer,
+            job.record,
+            job.output,
+            job.errors,
+            args.chunk_size,
+            lambda chunks: iter_scored_rows(scorer, executor, chunks, in_flight_limit),
+        )
+        return {"output": job.output, "errors": job.errors, **delta}
+    stats = scorer.stats
+    checkpoint = Checkpoint(job.record, job.output, job.errors)
+    trip_record, error_record, state = open_outputs(checkpoint, args.resume, args.format)
+    scored = iter_scored(
+        scorer,
+        executor,
+        job.record,
+        args.chunk_size,
+        state["next_row"],
+        max(args.workers, 1) * SHARDS_IN_FLIGHT,
+    )
+    writer = ShardWriter(trip_record, error_record, checkpoint, stats)
+    try:
+        # stream the record file block by block, each block is parsed, scored and
+        # written as columns (process_one_record / calculate_by_voyage stay for debugging)
+        shards = 0
+        for shard in scored if not state["complete"] else []:
+            if shard.last_row is None:
+                writer.put(shard)
+                continue
+            stats.count(shard.rows, shard.errors)
+            state["next_row"] = int(shard.last_row) + 1
+            state["rows"] += shard.rows
+            state["error_rows"] += shard.errors
+            shards += 1
+            writer.put(shard, state if shards % args.checkpoint_every == 0 else None)
+            stats.maybe_report()
+        state["complete"] = True
+        writer.put(None, state)
+    finally:
+        # shards already scored are still written and checkpointed
+        writer.close()
+    return {
+        "record": job.record,
+        "output": job.output,
+        "errors": job.errors,
+        "rows": state["rows"],
+        "error_rows": state["error_rows"],
+        "trips": state["rows"] - state["error_rows"],
+    }
+
+
+def parse_args(argv: tp.Optional[tp.Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="score voyage trips with NIS probability")
+    parser.add_argument(
+        "--record",
+        nargs="+",
+        default=[str(record_dir)],
+        help="moves_cleaned_*.txt files or globs",
+    )
+    parser.add_argument("--vessel", default=str(vessel_dir), help="vessel info file")
+    parser.add_argument("--place", default=str(place_dir), help="port info file")
+    parser.add_argument("--output", default=str(TRIP_RECORD_DIR), help="trip record output")
+    parser.add_argument("--errors", default=str(TRIP_ERROR_RECORD_DIR), help="error output")
+    parser.add_argument(
+        "--output-dir", default=str(DATA_DIR), help="outputs of several record files"
+    )
+    parser.add_argument(
+        "--format", choices=OUTPUT_FORMATS, default="text", help="trip output format"
+    )
+    parser.add_argument(
+        "--index",
+        default=str(TRIP_RECORD_INDEX_DIR),
+        help="json list of the outputs of several record files",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1, help="scoring processes"
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=RECORD_CHUNK_SIZE, help="record rows per shard"
+    )
+    parser.add_argument(
+        "--checkpoint-every",
+        type=int,
+        default=CHECKPOINT_EVERY,
+        help="shards between two checkpoints",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue from the last checkpoint instead of starting over",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="score only rows changed since the last --incremental run (text format)",
+    )
+    parser.add_argument(
+        "--report-interval",
+        type=float,
+        default=REPORT_INTERVAL,
+        help="seconds between progress lines, 0 for none",
+    )
+    parser.add_argument(
+        "--stats-json",
+        default=None,
+        help="json run summary (<output>.stats.json, <index>.stats.json for several files)",
+    )
+    return parser.parse_args(argv)
+
 
+def main(argv: tp.Optional[tp.Sequence[str]] = None) -> None:
+    args = parse_args(argv)
+    if args.incremental and args.format != "text":
+        raise ValueError("--incremental patches text outputs only")
+    jobs = record_jobs(
+        args.record, args.output, args.errors, args.output_dir, args.format
+    )
+    stats = PipelineStats(args.report_interval)
+    # parsers, caches and workers are built once for every record file
+    scorer = TripScorer(jobs[0].record, args.vessel, args.place, stats, args.format)
+    index = []
+    try:
+        with scoring_pool(scorer, args.workers) as executor:
+            for job in jobs:
+                index.append(run_job(scorer, executor, job, args))
+    finally:
+        scorer.save_caches()
+        print(stats.progress_line())
+        summary_dir = jobs[0].output if len(jobs) == 1 else args.index
+        stats.write_json(args.stats_json or f"{summary_dir}.stats.json")
+        if len(jobs) > 1:
+            with open(args.index, "w") as f:
+                json.dump(index, f, indent=2)
 
 
+if __name__ == "__main__":
+    main()
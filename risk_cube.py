@@ -0,0 +1,226 @@
+# materialized log-survival sums of scored trips
+# one cell per (destination port, origin port, origin country, vessel type, arrival
+# month) of the trips with a risk (risk_trips), holding sum log(1 - risk) and the count
+# of trips with a non zero risk, for ballast and biofouling. Roll-ups over any subset
+# of the dimensions are grouped from the cells (not the trips) once and kept, the cube
+# is saved next to its trip output as <output>.cube.npz and reused while the output is
+# unchanged; replace_ports rebuilds the cells of some destination ports only
+# the origin realm needs the port reference data (PortParser), it is only resolved per
+# origin port cell by add_realm when a realm roll-up is asked for and saved with the
+# source signature of that data
+import os
+import typing as tp
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from parsers import TRIP_RISK_COLUMNS, PortParser
+from survival import log_survival, risk_from_log_survival
+
+CUBE_DIMENSIONS = [
+    "d_port",
+    "d_port_id",
+    "o_port",
+    "o_port_id",
+    "o_port_country",
+    "o_port_realm",
+    "vessel_type",
+    "month",
+]
+CUBE_MEASURES = ["ballast_log", "biofouling_log", "ballast_trips", "biofouling_trips"]
+CUBE_VERSION = 3
+
+
+class RiskCube:
+    def __init__(
+        self,
+        cells: pd.DataFrame,
+        signature: tp.Optional[tp.List[int]] = None,
+        reference: str = "",
+    ) -> None:
+        # cells: categorical dimension columns (a subset of CUBE_DIMENSIONS) + CUBE_MEASURES
+        # signature: size / mtime of the trip output the cube was built from
+        # reference: PortParser.source_signature of the o_port_realm cells, "" without
+        self.cells = cells
+        self.dimensions = [dim for dim in CUBE_DIMENSIONS if dim in cells.columns]
+        self.signature = signature
+        self.reference = reference
+        self._rollups: tp.Dict[tp.Tuple[str, ...], pd.DataFrame] = {}
+
+    @classmethod
+    def from_trips(
+        cls,
+        trips: pd.DataFrame,
+        port_parser: tp.Optional[PortParser] = None,
+        signature: tp.Optional[tp.List[int]] = None,
+    ) -> "RiskCube":
+        # trips: scored trip table; dimensions whose source columns are missing are left out
+        # port_parser: add the origin realm (add_realm), None leaves it out
+        table = pd.DataFrame(index=trips.index)
+        for dim in CUBE_DIMENSIONS:
+            if dim in trips.columns:
+                table[dim] = trips[dim]
+        if "arrival_date" in trips.columns:
+            table["month"] = pd.to_datetime(trips["arrival_date"]).dt.strftime("%Y-%m")
+        dims = [dim for dim in CUBE_DIMENSIONS if dim in table.columns]
+        for dim in dims:
+            table[dim] = table[dim].astype("category")
+        for risk, name in zip(TRIP_RISK_COLUMNS, ["ballast", "biofouling"]):
+            values = trips[risk].to_numpy(dtype=float, na_value=np.nan)
+            table[f"{name}_log"] = log_survival(values)
+            table[f"{name}_trips"] = (values != 0.0).astype(np.int64)
+        cells = (
+            table.groupby(dims, observed=True, sort=False, dropna=False)[CUBE_MEASURES]
+            .sum()
+            .reset_index()
+        )
+        cube = cls(cells, signature)
+        if port_parser is not None:
+            cube.add_realm(port_parser)
+        return cube
+
+    def replace_ports(
+        self,
+        d_port_ids: tp.Iterable[int],
+        trips: pd.DataFrame,
+        port_parser: tp.Optional[PortParser] = None,
+        signature: tp.Optional[tp.List[int]] = None,
+    ) -> "RiskCube":
+        # cube with the cells of d_port_ids rebuilt from trips (their every risk_trips)
+        # and the other cells kept; a cube with o_port_realm resolves it again with
+        # port_parser, left out without one
+        if "d_port_id" not in self.dimensions:
+            raise ValueError("cube has no dimensions ['d_port_id'] to replace ports of")
+        kept = self.cells[~self.cells["d_port_id"].isin(list(d_port_ids))]
+        added = RiskCube.from_trips(trips).cells
+        dims = [dim for dim in self.dimensions if dim != "o_port_realm"]
+        cells = pd.concat(
+            [kept[dims + CUBE_MEASURES], added[dims + CUBE_MEASURES]], ignore_index=True
+        )
+        for dim in dims:
+            cells[dim] = cells[dim].astype(object).astype("category")
+        cube = RiskCube(cells, signature)
+        if "o_port_realm" in self.dimensions and port_parser is not None:
+            cube.add_realm(port_parser)
+        return cube
+
+    def add_realm(self, port_parser: PortParser) -> bool:
+        # resolve o_port_realm of every cell from its o_port_id, one lookup per origin
+        # port; realms of other reference data are resolved again
+        # return whether the cells changed
+        if "o_port_realm" in self.dimensions and self.reference == port_parser.source_signature:
+            return False
+        if "o_port_id" not in self.dimensions:
+            raise ValueError("cube has no dimensions ['o_port_id'] to resolve realms from")
+        o_port_ids = self.cells["o_port_id"]
+        realms = {
+            port_id: port_parser.check_meow_region(port_id)
+            for port_id in o_port_ids.cat.categories
+        }
+        self.cells["o_port_realm"] = pd.Categorical(o_port_ids.map(realms).astype(object))
+        self.dimensions = [dim for dim in CUBE_DIMENSIONS if dim in self.cells.columns]
+        self.reference = port_parser.source_signature
+        self._rollups = {
+            dims: rollup for dims, rollup in self._rollups.items() if "o_port_realm" not in dims
+        }
+        return True
+
+    @staticmethod
+    def cube_dir(trip_file_address: str) -> Path:
+        return Path(f"{trip_file_address}.cube.npz")
+
+    @classmethod
+    def load(cls, trip_file_address: str) -> tp.Optional["RiskCube"]:
+        # saved cube of the trip output, None when missing or the output changed since
+        try:
+            signature = trip_signature(trip_file_address)
+            with np.load(cls.cube_dir(trip_file_address)) as saved:
+                if int(saved["version"]) != CUBE_VERSION or list(saved["signature"]) != signature:
+                    return None
+                columns = {}
+                for dim in saved["dimensions"]:
+                    columns[dim] = pd.Categorical.from_codes(
+                        saved[f"{dim}_codes"], saved[f"{dim}_labels"]
+                    )
+                for measure in CUBE_MEASURES:
+                    columns[measure] = saved[measure]
+                reference = str(saved["reference"])
+        except (OSError, KeyError, ValueError):
+            return None
+        return cls(pd.DataFrame(columns), signature, reference)
+
+    def save(self, trip_file_address: str) -> None:
+        arrays = {
+            "version": np.array(CUBE_VERSION),
+            "signature": np.array(self.signature),
+            "dimensions": np.array(self.dimensions),
+            "reference": np.array(self.reference),
+        }
+        for dim in self.dimensions:
+            values = self.cells[dim].cat
+            arrays[f"{dim}_codes"] = values.codes.to_numpy()
+            # port ids stay numbers, the realm lookup is by id
+            labels = values.categories
+            arrays[f"{dim}_labels"] = (
+                labels.to_numpy(dtype=np.int64)
+                if labels.dtype.kind in "iu"
+                else labels.to_numpy(dtype=str)
+            )
+        for measure in CUBE_MEASURES:
+            arrays[measure] = self.cells[measure].to_numpy()
+        cube_dir = self.cube_dir(trip_file_address)
+        temp_file = cube_dir.with_name(f"{cube_dir.name}.{os.getpid()}.tmp")
+        try:
+            with open(temp_file, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(temp_file, cube_dir)
+        except OSError:
+            pass
+
+    def rollup(self, dims: tp.Sequence[str]) -> pd.DataFrame:
+        # ballast_risk / biofouling_risk (1 - prod(1 - risk)) and ballast_trips /
+        # biofouling_trips per combination of dims, grouped from the cells once per dims
+        dims = tuple(dims)
+        if dims not in self._rollups:
+            missing = [dim for dim in dims if dim not in self.dimensions]
+            if missing or not dims:
+                raise ValueError(f"cube has no dimensions {missing or dims}")
+            grouped = self.cells.groupby(list(dims), observed=True, sort=False)[
+                CUBE_MEASURES
+            ].sum()
+            self._rollups[dims] = pd.DataFrame(
+                {
+                    "ballast_risk": risk_from_log_survival(grouped["ballast_log"].to_numpy()),
+                    "biofouling_risk": risk_from_log_survival(
+                        grouped["biofouling_log"].to_numpy()
+                    ),
+                    "ballast_trips": grouped["ballast_trips"].to_numpy(),
+                    "biofouling_trips": grouped["biofouling_trips"].to_numpy(),
+                },
+                index=grouped.index,
+            )
+        return self._rollups[dims]
+
+
+def risk_trips(trips: pd.DataFrame) -> pd.DataFrame:
+    # trips with a non zero risk, the others add nothing to an aggregate
+    return trips[
+        ((trips["ballast_risk"] != 0.0) | (trips["biofouling_risk"] != 0.0))
+        & ((~trips["ballast_risk"].isna()) | (~trips["biofouling_risk"].isna()))
+    ]
+
+
+def trip_signature(trip_file_address: str) -> tp.List[int]:
+    # size / mtime of a trip text file, file count / total size / latest mtime of a
+    # parquet store
+    path = Path(trip_file_address)
+    if not path.is_dir():
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+    stats = [os.stat(part) for part in path.rglob("*.parquet")]
+    return [
+        len(stats),
+        sum(stat.st_size for stat in stats),
+        max((stat.st_mtime_ns for stat in stats), default=0),
+    ]
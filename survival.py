@@ -0,0 +1,15 @@
+# combining independent trip risks: 1 - prod(1 - risk) is computed as
+# 1 - exp(sum log(1 - risk)), so per group sums can be added, subtracted and kept
+# without the product underflowing; used by the aggregates, sweeps and scenarios
+import numpy as np
+
+
+def log_survival(risk: np.ndarray) -> np.ndarray:
+    # log(1 - risk), trips without a risk (missing env / vessel values) count as 0
+    survival = np.log1p(-risk)
+    return np.where(np.isnan(survival), 0.0, survival)
+
+
+def risk_from_log_survival(log_survival: np.ndarray) -> np.ndarray:
+    # 1 - exp(sum of log(1 - risk)), + 0.0 turns the -0.0 of riskless groups into 0.0
+    return -np.expm1(log_survival) + 0.0
@@ -0,0 +1,84 @@
+# the modules live at the repository root
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+VESSEL_TYPES = ["UCC", "TCR", "BBU", "GGC", "ZZZ", "LNG"]
+COUNTRIES = ["SGP", "CHN", "USA", "KOR", "JPN", "NLD", "DEU"]
+
+
+def write_moves(path, rows, port_ids, vessels, year=2015, seed=1):
+    # moves_cleaned file of rows port calls between port_ids
+    rng = np.random.default_rng(seed)
+    lines = ["MOVE ID|VESSEL ID|PLACE ID|ARRIVAL DATE|SAIL DATE|STAY DURATION|DURATION|"
+             "BALLAST DISCHARGE|ROUT"]
+    for row in range(rows):
+        origin, desti = (int(port_id) for port_id in rng.choice(port_ids, 2))
+        month, day = int(rng.integers(1, 13)), int(rng.integers(1, 28))
+        arrival = f"{year}-{month:02d}-{day:02d}"
+        lines.append(
+            f"{row}|{int(rng.integers(0, vessels + 5))}|{desti}|{arrival} 10:00:00|"
+            f"{arrival} 22:30:00|{rng.uniform(0.1, 20):.3f}|{rng.uniform(0.5, 40):.3f}|"
+            f"{rng.uniform(0, 5e4):.5f}|{origin}-{desti}"
+        )
+    Path(path).write_text("\n".join(lines) + "\n")
+
+
+@pytest.fixture(scope="session")
+def sample_data(tmp_path_factory):
+    # places / env / vessel / record files over MEOW ecoregions, env file patched in
+    gpd = pytest.importorskip("geopandas")
+    import parsers
+
+    data_dir = tmp_path_factory.mktemp("data")
+    rng = np.random.default_rng(0)
+    meow = gpd.read_file(parsers.MEOW_DIR)
+    points = meow.geometry.representative_point()
+    places = ["PLACE ID|PLACE NAME|COUNTRY CODE|LATITUDE DECIMAL|LONGITUDE DECIMAL|PORT TYPE"]
+    env = ["ID,NAME,MIN_T,MAX_T,RANGE_T,YR_MEAN_T,Salinity,Temp_Src,Sal_Src,MEOW_region,"
+           "MEOW_province,MEOW_Neighbors,FEOW_region"]
+    port_ids = []
+    for i in range(40):
+        region = i * 5 % len(meow)
+        port_id = 1000 + i
+        port_ids.append(port_id)
+        places.append(
+            f"{port_id}|Port{i}|{COUNTRIES[i % len(COUNTRIES)]}|{points.iloc[region].y}|"
+            f"{points.iloc[region].x}|X"
+        )
+        # the last ports have their env derived from their ecoregion
+        if i < 36:
+            eco = meow.ECOREGION.iloc[region]
+            neighbours = "|".join([meow.ECOREGION.iloc[(region + 5) % len(meow)], "NA"]
+                                  + ([eco] if i % 4 == 0 else []))
+            temperature = rng.uniform(2, 28)
+            env.append(
+                f"{port_id},Port{i},{temperature - 5:.2f},{temperature + 5:.2f},10,"
+                f"{temperature:.2f},{rng.uniform(5, 36):.2f},WOA,WOA,\"{eco}\","
+                f"\"{meow.PROVINCE.iloc[region]}\",\"{neighbours}\","
+            )
+    # a port without a position
+    places.append("2000|BadPos|USA|||X")
+    vessels = ["VESSEL ID|IMO|VESSEL NAME|VESSEL TYPE|BUILT|GROSS|DWT|LENGTH OVERALL|"
+               "BREADTH EXTREME|DEPTH|DRAFT"]
+    for vessel in range(120):
+        vessels.append(
+            f"{vessel}|{9000000 + vessel}|V{vessel}|{VESSEL_TYPES[vessel % 6]}|"
+            f"{1990 + vessel % 30}|{rng.uniform(1e3, 1e5):.1f}|{rng.uniform(1e3, 2e5):.1f}|"
+            f"{rng.uniform(50, 350):.1f}|{rng.uniform(10, 60):.1f}|"
+            f"{rng.uniform(5, 30):.1f}|{rng.uniform(3, 20):.1f}"
+        )
+    (data_dir / "places.lst").write_text("\n".join(places) + "\n")
+    (data_dir / "env.csv").write_text("\n".join(env) + "\n")
+    (data_dir / "vessels.txt").write_text("\n".join(vessels) + "\n")
+    write_moves(data_dir / "moves_cleaned_2015.txt", 1500, port_ids + [2000], 120)
+
+    patch = pytest.MonkeyPatch()
+    patch.setattr(parsers, "GIVEN_FILE_DIR", data_dir / "env.csv")
+    yield data_dir
+    patch.undo()
@@ -0,0 +1,135 @@
+# the columnar scoring path against the per voyage one it replaced
+import numpy as np
+import pandas as pd
+import pytest
+
+from nis_probability import NIS
+from parsers import (
+    TRIP_FILE_COLUMNS,
+    PortInfo,
+    PortPairCache,
+    RegionAdjacency,
+    VesselInfo,
+    VoyageTrip,
+    round_like_scalar,
+    trips_to_str,
+)
+
+
+def _port(port_id, lat, yr_mean_t, salinity, region, neighbours):
+    port = PortInfo(id=port_id, port_name=f"Port{port_id}")
+    port.set_geo_info(lat, 0.0, None, None, None)
+    port.yr_mean_t = yr_mean_t
+    port.salinity = salinity
+    port.set_meow(meow_region=region, meow_province=region, meow_neighbour=neighbours)
+    return port
+
+
+def test_round_like_scalar_matches_round():
+    rng = np.random.default_rng(0)
+    values = np.concatenate(
+        [
+            [873.32225, 2.675, 0.00005, 1.00005],
+            rng.integers(0, 10**9, 20000) / 10**5,
+            rng.uniform(0, 2e5, 20000),
+        ]
+    )
+    rounded = round_like_scalar(pd.Series(values), 4)
+    assert rounded.tolist() == [round(float(value), 4) for value in values]
+    assert round_like_scalar(pd.Series([np.nan, 1.5]), 0).isna().tolist() == [True, False]
+
+
+def test_calculate_batch_matches_calculate_by_voyage():
+    nis = NIS()
+    rng = np.random.default_rng(1)
+    n = 200
+    origin_lat = rng.uniform(-60, 60, n)
+    origin_t, desti_t = rng.uniform(0, 30, n), rng.uniform(0, 30, n)
+    origin_s, desti_s = rng.uniform(5, 40, n), rng.uniform(5, 40, n)
+    ballast = rng.uniform(0, 5e4, n)
+    voyage_duration, stay_duration = rng.uniform(0.5, 40, n), rng.uniform(0.1, 30, n)
+    anti_p, avg_sog = rng.uniform(0, 1, n), rng.uniform(1e4, 1e6, n)
+    batch_ballast, batch_biofouling = nis.calculate_batch(
+        np.abs(desti_t - origin_t),
+        np.abs(desti_s - origin_s),
+        ballast,
+        voyage_duration,
+        stay_duration,
+        origin_lat,
+        anti_p,
+        avg_sog,
+    )
+    for i in range(n):
+        trip = VoyageTrip()
+        trip.origin_port = _port(1, origin_lat[i], origin_t[i], origin_s[i], "A", [])
+        trip.desti_port = _port(2, 0.0, desti_t[i], desti_s[i], "B", [])
+        trip.vessel = VesselInfo(antifouling_factor=anti_p[i])
+        trip.ballast_discharge = ballast[i]
+        trip.voyage_duration = voyage_duration[i]
+        trip.stay_duration = stay_duration[i]
+        trip.voyage_avg_sog = avg_sog[i]
+        p_ballast, p_biofouling = nis.calculate_by_voyage(trip)
+        np.testing.assert_allclose(batch_ballast[i], p_ballast, rtol=1e-12)
+        np.testing.assert_allclose(batch_biofouling[i], p_biofouling, rtol=1e-12)
+
+
+def test_trips_to_str_missing_values():
+    trips = pd.DataFrame({column: ["x", "x"] for column in TRIP_FILE_COLUMNS})
+    trips["vessel_imo"] = pd.array([9000002, None], dtype="Int64")
+    trips["ballast_risk"] = [0.5, np.nan]
+    lines = trips_to_str(trips).split("\n")[:-1]
+    imo = TRIP_FILE_COLUMNS.index("vessel_imo")
+    assert [line.split("|")[imo] for line in lines] == ["9000002", ""]
+    assert lines[1].split("|")[TRIP_FILE_COLUMNS.index("ballast_risk")] == ""
+
+
+def test_trips_to_str_midnight_dates():
+    # a block of midnight only dates keeps the time like VoyageTrip.output_to_str
+    trips = pd.DataFrame({column: ["x"] for column in TRIP_FILE_COLUMNS})
+    trips["arrival_date"] = pd.to_datetime(["2015-10-04 00:00:00"])
+    trips["departure_date"] = pd.to_datetime(["2015-10-05 00:00:00"])
+    fields = trips_to_str(trips).split("\n")[0].split("|")
+    arrival = TRIP_FILE_COLUMNS.index("arrival_date")
+    assert fields[arrival : arrival + 2] == ["2015-10-04 00:00:00", "2015-10-05 00:00:00"]
+
+
+def test_indigenous_batch_matches_process_indigenous():
+    # ports 0 / 1 share region A without listing it, port 2 lists its own region A
+    region_list = ["A", "A", "A", "B", None]
+    neighbour_list = ["B|NA", "NA", "A|B", "A", ""]
+    ports = [
+        _port(i, 0.0, 10.0, 30.0, region, [n for n in neighbour.split("|") if n != "NA"])
+        for i, (region, neighbour) in enumerate(zip(region_list, neighbour_list))
+    ]
+    ports[4].has_meow_region = None
+    regions = pd.Series(region_list, dtype=object)
+    neighbours = pd.Series(neighbour_list, dtype=object)
+    adjacency = RegionAdjacency(regions, neighbours)
+    codes = adjacency.encode(regions, neighbours)
+    origin, desti = np.repeat(np.arange(5), 5), np.tile(np.arange(5), 5)
+    no_feow = np.full(len(origin), -1)
+    nis = NIS()
+    batch = nis.indigenous_batch(
+        codes[origin], codes[desti], no_feow, no_feow, adjacency, RegionAdjacency(None)
+    )
+    scalar = [nis.process_indigenous(ports[o], ports[d]) for o, d in zip(origin, desti)]
+    assert batch.tolist() == scalar
+
+
+def test_port_pair_cache_subclass_needs_compute():
+    # an incomplete cache fails when built, not at its first lookup
+    class _NoCompute(PortPairCache):
+        value_names = ("value",)
+
+        def _cache_signature(self):
+            return "none"
+
+    with pytest.raises(TypeError):
+        _NoCompute()
+
+    class _Sum(_NoCompute):
+        def _compute(self, keys):
+            origin_ids, desti_ids = self.split_key(keys)
+            return [(origin_ids + desti_ids).astype(float)]
+
+    assert _Sum().get(2, 3) == (5.0,)
@@ -0,0 +1,96 @@
+# --incremental refresh against a fresh run over the same record file
+import json
+
+import numpy as np
+
+import process_origin_trips
+from aggregate_risk import AggregateRisk
+from parsers import PortParser
+from risk_cube import RiskCube
+
+
+def _run(data_dir, record, output, *extra):
+    process_origin_trips.main(
+        [
+            "--record", str(record),
+            "--vessel", str(data_dir / "vessels.txt"),
+            "--place", str(data_dir / "places.lst"),
+            "--output", str(output),
+            "--errors", f"{output}.err",
+            "--chunk-size", "200",
+            "--report-interval", "1000",
+            *extra,
+        ]
+    )
+
+
+def _edit_record(record):
+    # change, delete and insert rows (a repeated port call among them)
+    lines = record.read_text().split("\n")[:-1]
+    header, rows = lines[0], lines[1:]
+    for row in [3, 400, 401, 1200]:
+        fields = rows[row].split("|")
+        fields[7] = str(float(fields[7]) * 3 + 1)
+        rows[row] = "|".join(fields)
+    del rows[700]
+    del rows[1000:1003]
+    rows.insert(5, rows[40])
+    rows.insert(900, rows[100])
+    rows.append(rows[7])
+    record.write_text("\n".join([header] + rows) + "\n")
+
+
+def _error_rows(error_file):
+    # error lines without the time they were written
+    return [line.rsplit("|", 1)[0] for line in error_file.read_text().splitlines()]
+
+
+def test_refresh_matches_fresh_run(sample_data, tmp_path):
+    record = tmp_path / "moves_cleaned_2015.txt"
+    record.write_text((sample_data / "moves_cleaned_2015.txt").read_text())
+    output = tmp_path / "incremental.txt"
+    _run(sample_data, record, output, "--incremental", "--workers", "2")
+    # a cube of the output, with realms, to be patched by the refresh
+    port_parser = PortParser(sample_data / "places.lst")
+    AggregateRisk(output, port_parser=port_parser).aggregate_by_realm("Port3")
+
+    _edit_record(record)
+    _run(sample_data, record, output, "--incremental", "--workers", "2")
+    delta = json.loads((tmp_path / "incremental.txt.delta.json").read_text())
+    # 4 changed and 3 inserted rows at most, 4 deleted and 4 changed ones at least
+    assert 0 < delta["scored"] <= 7 and delta["deleted"] >= 8
+    assert delta["d_port_ids"]
+
+    _run(sample_data, record, tmp_path / "fresh.txt")
+    assert output.read_bytes() == (tmp_path / "fresh.txt").read_bytes()
+    assert _error_rows(tmp_path / "incremental.txt.err") == _error_rows(
+        tmp_path / "fresh.txt.err"
+    )
+
+    patched = RiskCube.load(output)
+    assert patched is not None and "o_port_realm" in patched.dimensions
+    fresh = AggregateRisk(tmp_path / "fresh.txt", port_parser=port_parser)
+    fresh.aggregate_by_realm("Port3")
+    for dims in [["d_port"], ["d_port", "o_port_country"], ["d_port", "o_port_realm"]]:
+        got = patched.rollup(dims).sort_index()
+        expected = fresh.cube.rollup(dims).sort_index()
+        assert list(got.index) == list(expected.index)
+        assert np.allclose(got.to_numpy(float), expected.to_numpy(float), rtol=1e-12)
+
+
+def test_refresh_rescores_on_new_vessel_file(sample_data, tmp_path):
+    record = sample_data / "moves_cleaned_2015.txt"
+    vessels = tmp_path / "vessels.txt"
+    vessels.write_text((sample_data / "vessels.txt").read_text())
+    data_dir = tmp_path
+    (data_dir / "places.lst").write_text((sample_data / "places.lst").read_text())
+    output = tmp_path / "incremental.txt"
+    _run(data_dir, record, output, "--incremental")
+    _run(data_dir, record, output, "--incremental")
+    delta = json.loads((tmp_path / "incremental.txt.delta.json").read_text())
+    assert delta["scored"] == 0
+
+    vessels.write_text(vessels.read_text().replace("|UCC|", "|BBU|", 1))
+    _run(data_dir, record, output, "--incremental")
+    delta = json.loads((tmp_path / "incremental.txt.delta.json").read_text())
+    assert delta["unchanged"] == 0 and delta["scored"] == delta["rows"]
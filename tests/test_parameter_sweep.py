@@ -0,0 +1,46 @@
+# ParameterSweep against scoring the trips once per parameter set
+import numpy as np
+import pytest
+
+from nis_probability import NIS
+from parameter_sweep import ParameterSweep, parameter_grid
+from parsers import RecordParser
+
+
+def test_sweep_matches_trip_scores(sample_data):
+    record_parser = RecordParser(
+        sample_data / "moves_cleaned_2015.txt",
+        sample_data / "vessels.txt",
+        sample_data / "places.lst",
+    )
+    sweep = ParameterSweep.from_record_parser(record_parser)
+    grid = parameter_grid(
+        ballast_lambda=[3.22e-6, 1e-5],
+        establish_alpha=[1.5e-4, 3e-4],
+        biofuling_tropical_lat=[0.35, 30.0],
+    )
+    result = sweep.run(grid)
+    assert np.allclose(result, sweep.run(grid, block_size=37), rtol=1e-12, atol=0)
+
+    trips, _ = record_parser.process_records_batch()
+    for set_id, row in grid.iterrows():
+        nis = NIS()
+        for name, value in row.items():
+            setattr(nis, name, value)
+        scored = nis.calculate_trip_table(trips, record_parser.port_parser)
+        expected = scored.groupby("d_port_id").agg(
+            ballast_risk=("ballast_risk", lambda risk: 1 - np.prod(1 - risk.dropna())),
+            biofouling_risk=("biofouling_risk", lambda risk: 1 - np.prod(1 - risk.dropna())),
+        )
+        got = result.loc[set_id].reindex(expected.index).fillna(0.0)
+        assert np.allclose(got, expected, rtol=1e-9, atol=1e-18)
+
+
+def test_biofouling_probability_uses_tropical_lat():
+    nis = NIS()
+    nis.biofuling_tropical_lat = 30.0
+    scalar = nis.biofouling_probability(20.0, 0.5, 12.0, 3.0)
+    (batch,) = nis.biofouling_batch([20.0], [0.5], [12.0], [3.0])
+    assert scalar == pytest.approx(batch, rel=1e-12)
+    nis.biofuling_tropical_lat = 0.35
+    assert nis.biofouling_probability(20.0, 0.5, 12.0, 3.0) != pytest.approx(scalar)
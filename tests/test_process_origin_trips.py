@@ -0,0 +1,77 @@
+# process_origin_trips runs over the sample data
+import json
+import os
+import threading
+
+import pytest
+
+import parsers
+import process_origin_trips
+
+
+def _run(data_dir, output, *extra):
+    process_origin_trips.main(
+        [
+            "--record", str(data_dir / "moves_cleaned_2015.txt"),
+            "--vessel", str(data_dir / "vessels.txt"),
+            "--place", str(data_dir / "places.lst"),
+            "--output", str(output),
+            "--errors", f"{output}.err",
+            "--chunk-size", "200",
+            "--report-interval", "1000",
+            *extra,
+        ]
+    )
+
+
+def test_workers_fork_before_writer_thread(sample_data, tmp_path):
+    forks = []
+    os.register_at_fork(
+        before=lambda: forks.append(sorted(thread.name for thread in threading.enumerate()))
+    )
+    _run(sample_data, tmp_path / "trips.txt", "--workers", "2")
+    assert forks and all(threads == ["MainThread"] for threads in forks)
+
+
+def _error_rows(error_file):
+    # error lines without the time they were written
+    return [line.rsplit("|", 1)[0] for line in error_file.read_text().splitlines()]
+
+
+def test_resume_after_crash_matches_uninterrupted_run(sample_data, tmp_path, monkeypatch):
+    _run(sample_data, tmp_path / "full.txt")
+
+    score = process_origin_trips.TripScorer.score
+    first_rows = []
+
+    def crash_on_fourth_shard(self, chunk):
+        first_rows.append(int(chunk.index[0]))
+        if len(first_rows) == 4:
+            raise RuntimeError("crash")
+        return score(self, chunk)
+
+    monkeypatch.setattr(process_origin_trips.TripScorer, "score", crash_on_fourth_shard)
+    with pytest.raises(RuntimeError):
+        _run(sample_data, tmp_path / "resumed.txt", "--checkpoint-every", "2")
+    checkpoint = json.loads((tmp_path / "resumed.txt.checkpoint").read_text())
+    assert checkpoint["next_row"] == 400 and not checkpoint["complete"]
+
+    first_rows.clear()
+    monkeypatch.setattr(
+        process_origin_trips.TripScorer,
+        "score",
+        lambda self, chunk: first_rows.append(int(chunk.index[0])) or score(self, chunk),
+    )
+    read_pipe_file = parsers.read_pipe_file
+    skipped = []
+    monkeypatch.setattr(
+        parsers,
+        "read_pipe_file",
+        lambda *args, **kwargs: skipped.append(kwargs.get("skip_rows", 0))
+        or read_pipe_file(*args, **kwargs),
+    )
+    _run(sample_data, tmp_path / "resumed.txt", "--checkpoint-every", "2", "--resume")
+    # the rows before the checkpoint are neither parsed nor scored again
+    assert skipped == [400] and first_rows[0] == 400
+    assert (tmp_path / "resumed.txt").read_bytes() == (tmp_path / "full.txt").read_bytes()
+    assert _error_rows(tmp_path / "resumed.txt.err") == _error_rows(tmp_path / "full.txt.err")
@@ -0,0 +1,153 @@
+# AggregateRisk roll-ups of the saved RiskCube against per port products of the trips
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import aggregate_risk
+from aggregate_risk import AggregateRisk
+from parsers import TRIP_FILE_COLUMNS, trips_to_str
+from risk_cube import RiskCube
+
+REALMS = ["Arctic", "Temperate Northern Atlantic", "Central Indo-Pacific"]
+
+
+class _RealmPorts:
+    # the PortParser surface of the realm aggregates: realm of an origin port by id
+    def __init__(self, source_signature="ports-1"):
+        self.source_signature = source_signature
+        self.meow_table = pd.DataFrame({"REALM": REALMS})
+
+    def check_meow_region(self, port_id):
+        return REALMS[int(port_id) % len(REALMS)]
+
+
+def _trips(rows=600, seed=0):
+    rng = np.random.default_rng(seed)
+    trips = pd.DataFrame({column: ["x"] * rows for column in TRIP_FILE_COLUMNS})
+    d_port_ids = rng.integers(0, 6, rows)
+    o_port_ids = rng.integers(10, 30, rows)
+    trips["d_port_id"] = d_port_ids
+    trips["d_port"] = [f"Port{port_id}" for port_id in d_port_ids]
+    trips["o_port_id"] = o_port_ids
+    trips["o_port"] = [f"Port{port_id}" for port_id in o_port_ids]
+    trips["o_port_country"] = [["SGP", "CHN", "USA"][port_id % 3] for port_id in o_port_ids]
+    trips["vessel_type"] = rng.choice(["UCC", "TCR"], rows)
+    trips["vessel_imo"] = pd.array([None] * rows, dtype="Int64")
+    trips["arrival_date"] = pd.Timestamp("2015-01-01") + pd.to_timedelta(
+        rng.integers(0, 365, rows), "D"
+    )
+    trips["departure_date"] = trips["arrival_date"]
+    for risk in ["ballast_risk", "biofouling_risk"]:
+        values = rng.uniform(0, 1e-3, rows)
+        values[rng.random(rows) < 0.3] = 0.0
+        values[rng.random(rows) < 0.05] = np.nan
+        trips[risk] = values
+    return trips
+
+
+def _product_risk(risks):
+    # 1 - prod(1 - risk), trip by trip, missing risks skipped
+    survival = 1.0
+    for risk in risks:
+        if not math.isnan(risk):
+            survival *= 1 - risk
+    return 1 - survival
+
+
+def _write(path, trips):
+    path.write_text(trips_to_str(trips))
+
+
+def test_aggregates_match_per_port_products(tmp_path):
+    trips = _trips()
+    _write(tmp_path / "trips.txt", trips)
+    aggregate = AggregateRisk(tmp_path / "trips.txt", port_parser=_RealmPorts())
+    # the trip output keeps only trips with a risk, as the aggregates did
+    kept = trips[
+        ((trips["ballast_risk"] != 0.0) | (trips["biofouling_risk"] != 0.0))
+        & (trips["ballast_risk"].notna() | trips["biofouling_risk"].notna())
+    ]
+    for port_id in range(6):
+        port = kept[kept["d_port_id"] == port_id]
+        ballast, biofouling = aggregate.aggregate_one_port(f"Port{port_id}")
+        assert ballast == pytest.approx(_product_risk(port["ballast_risk"]), rel=1e-12)
+        assert biofouling == pytest.approx(_product_risk(port["biofouling_risk"]), rel=1e-12)
+
+        by_country = aggregate.aggregate_by_country(f"Port{port_id}")
+        for risk, got in zip(["ballast_risk", "biofouling_risk"], by_country):
+            with_risk = port[port[risk] != 0.0]
+            expected = {
+                country: _product_risk(group[risk])
+                for country, group in with_risk.groupby("o_port_country")
+            }
+            assert got.keys() == expected.keys()
+            assert got == pytest.approx(expected, rel=1e-12)
+
+        by_realm = aggregate.aggregate_by_realm(f"Port{port_id}")
+        realms = port["o_port_id"].map(lambda port_id: REALMS[port_id % len(REALMS)])
+        for risk, got in zip(["ballast_risk", "biofouling_risk"], by_realm):
+            expected = {realm: 0.0 for realm in REALMS}
+            for realm, group in port.groupby(realms):
+                expected[realm] = _product_risk(group[risk])
+            assert got == pytest.approx(expected, rel=1e-12)
+    assert aggregate.aggregate_one_port("Nowhere") == (0.0, 0.0)
+
+
+def test_saved_cube_is_reused_until_the_output_changes(tmp_path, monkeypatch):
+    trips = _trips()
+    output = tmp_path / "trips.txt"
+    _write(output, trips)
+    expected = AggregateRisk(output, port_parser=_RealmPorts()).aggregate_by_realm("Port1")
+    assert RiskCube.cube_dir(output).exists()
+
+    read_pipe_file = aggregate_risk.read_pipe_file
+
+    def no_trip_reads(*args, **kwargs):
+        raise AssertionError("trips read in place of the saved cube")
+
+    monkeypatch.setattr(aggregate_risk, "read_pipe_file", no_trip_reads)
+    saved = AggregateRisk(output, port_parser=_RealmPorts())
+    assert saved.aggregate_by_realm("Port1") == expected
+    port = trips[trips["d_port_id"] == 1]
+    assert saved.aggregate_one_port("Port1")[1] == pytest.approx(
+        _product_risk(port["biofouling_risk"]), rel=1e-12
+    )
+
+    # a new output is read again
+    monkeypatch.setattr(aggregate_risk, "read_pipe_file", read_pipe_file)
+    trips["ballast_risk"] = trips["ballast_risk"] * 2
+    _write(output, trips)
+    changed = AggregateRisk(output, port_parser=_RealmPorts())
+    port = trips[trips["d_port_id"] == 1]
+    assert changed.aggregate_one_port("Port1")[0] == pytest.approx(
+        _product_risk(port["ballast_risk"]), rel=1e-12
+    )
+    assert changed._record is not None
+
+
+def test_cube_realms_follow_the_port_reference(tmp_path):
+    output = tmp_path / "trips.txt"
+    _write(output, _trips())
+    AggregateRisk(output, port_parser=_RealmPorts("ports-1")).aggregate_by_realm("Port1")
+    assert RiskCube.load(output).reference == "ports-1"
+
+    # other reference data: realms resolved again and saved with it
+    class _OtherRealms(_RealmPorts):
+        def check_meow_region(self, port_id):
+            return REALMS[0]
+
+    other = AggregateRisk(output, port_parser=_OtherRealms("ports-2"))
+    ballast, _ = other.aggregate_by_realm("Port1")
+    assert ballast[REALMS[1]] == ballast[REALMS[2]] == 0.0
+    assert ballast[REALMS[0]] == pytest.approx(other.aggregate_one_port("Port1")[0])
+    assert RiskCube.load(output).reference == "ports-2"
+
+    # aggregates without realms never touch the port reference data
+    cube = RiskCube.load(output)
+    assert "o_port_realm" in cube.dimensions
+    plain = AggregateRisk(output)
+    plain.aggregate_by_country("Port1")
+    plain.aggregate_one_port("Port1")
+    assert plain._port_parser is None
@@ -0,0 +1,67 @@
+# parquet trip store written by process_origin_trips --format parquet
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from parsers import TRIP_FILE_COLUMNS, TRIP_SCHEMA
+from trip_store import ParquetTripWriter, read_trip_parquet
+
+
+def _trips(rows, ports, seed=0):
+    rng = np.random.default_rng(seed)
+    d_port_ids = rng.integers(0, ports, rows)
+    d_port_ids[:ports] = np.arange(ports)
+    arrival = pd.Timestamp("2015-01-01") + pd.to_timedelta(rng.integers(0, 700, rows), "D")
+    trips = {}
+    for column in TRIP_FILE_COLUMNS:
+        tg_type = TRIP_SCHEMA[column]
+        if tg_type == "int":
+            trips[column] = rng.integers(0, 10**6, rows)
+        elif tg_type == "float":
+            trips[column] = rng.uniform(0, 1, rows)
+        elif tg_type == "datetime":
+            trips[column] = arrival
+        else:
+            trips[column] = [f"V{value}" for value in rng.integers(0, 50, rows)]
+    trips = pd.DataFrame(trips)
+    trips["d_port_id"] = d_port_ids
+    trips["d_port"] = [f"Port{port_id}" for port_id in d_port_ids]
+    return trips
+
+
+def _sorted(trips):
+    key = ["d_port_id", "vessel_id", "arrival_date"]
+    return trips.sort_values(key).reset_index(drop=True)
+
+
+def test_parquet_store_of_many_ports(tmp_path):
+    trips = _trips(12000, 3000)
+    writer = ParquetTripWriter(tmp_path / "trips.parquet", flush_rows=5000)
+    writer.write(trips.iloc[:7000])
+    writer.write(trips.iloc[7000:])
+    assert writer.flush() == 2
+    # one file per year and flush, not per destination port
+    assert len(list((tmp_path / "trips.parquet").rglob("*.parquet"))) == 4
+
+    got = _sorted(read_trip_parquet(tmp_path / "trips.parquet"))
+    expected = _sorted(trips)
+    assert len(got) == len(expected)
+    for column in TRIP_FILE_COLUMNS:
+        assert (got[column].astype(str) == expected[column].astype(str)).all(), column
+
+    some = read_trip_parquet(
+        tmp_path / "trips.parquet", ["d_port_id", "ballast_risk"], d_port_ids=[5, 2999]
+    )
+    assert sorted(some["d_port_id"].unique()) == [5, 2999]
+    assert len(some) == trips["d_port_id"].isin([5, 2999]).sum()
+
+
+def test_parquet_store_truncate(tmp_path):
+    trips = _trips(3000, 1500)
+    writer = ParquetTripWriter(tmp_path / "trips.parquet", flush_rows=1000)
+    for start in range(0, 3000, 1000):
+        writer.write(trips.iloc[start : start + 1000])
+    ParquetTripWriter(tmp_path / "trips.parquet").truncate(2)
+    assert len(read_trip_parquet(tmp_path / "trips.parquet")) == 2000
@@ -0,0 +1,161 @@
+# ballast water treatment scenarios over a fixed trip table
+# a scenario is a list of TreatmentRule (efficacy per vessel type / DWT band / arrival
+# date range); only the ballast term depends on treatment, so the establishment factor
+# (EstablishmentCache) and the biofouling risk are computed once, and a scenario only
+# re-scores the trips its rules match and updates the aggregates of their ports
+import typing as tp
+
+import attr
+import numpy as np
+import pandas as pd
+
+from nis_probability import NIS, EstablishmentCache
+from parsers import TYPE_DICT, PortParser
+from survival import log_survival, risk_from_log_survival
+
+
+@attr.s(frozen=True)
+class TreatmentRule:
+    # treatment efficacy (share of organisms removed) of matching trips
+    # vessel_types: vessel type codes or TYPE_DICT groups, None matches every type
+    # DWT band [min_dwt, max_dwt) and arrival date range [start, end), None is open
+    efficacy = attr.ib()
+    vessel_types = attr.ib(default=None)
+    min_dwt = attr.ib(default=None)
+    max_dwt = attr.ib(default=None)
+    start = attr.ib(default=None)
+    end = attr.ib(default=None)
+
+    @efficacy.validator
+    def _check_efficacy(self, attribute, value):
+        if not 0.0 <= value <= 1.0:
+            raise ValueError(f"treatment efficacy {value} not in [0, 1]")
+
+    def type_codes(self) -> tp.Optional[tp.Set[str]]:
+        if self.vessel_types is None:
+            return None
+        codes = set()
+        for vessel_type in self.vessel_types:
+            codes.update(TYPE_DICT.get(vessel_type, [vessel_type]))
+        return codes
+
+    def match(self, trips: pd.DataFrame) -> np.ndarray:
+        matched = np.ones(len(trips), dtype=bool)
+        codes = self.type_codes()
+        if codes is not None:
+            matched &= trips["vessel_type"].isin(codes).to_numpy()
+        dwt = trips["vessel_dwt"].to_numpy(dtype=float, na_value=np.nan)
+        if self.min_dwt is not None:
+            matched &= dwt >= self.min_dwt
+        if self.max_dwt is not None:
+            matched &= dwt < self.max_dwt
+        arrival = trips["arrival_date"]
+        if self.start is not None:
+            matched &= (arrival >= pd.Timestamp(self.start)).to_numpy()
+        if self.end is not None:
+            matched &= (arrival < pd.Timestamp(self.end)).to_numpy()
+        return matched
+
+
+class TreatmentScenarios:
+    def __init__(
+        self,
+        trips: pd.DataFrame,
+        port_parser: PortParser,
+        nis: tp.Optional[NIS] = None,
+        establish_cache: tp.Optional[EstablishmentCache] = None,
+        group_column: str = "d_port_id",
+    ):
+        # trips: RecordParser.process_records_batch table
+        # baseline is NIS.treatment for every trip
+        self.nis = nis if nis is not None else NIS()
+        self.group_column = group_column
+        self.trips = trips[["vessel_type", "vessel_dwt", "arrival_date"]]
+        codes, groups = pd.factorize(trips[group_column], sort=True)
+        self.groups = pd.Index(groups, name=group_column)
+        self._group_codes = codes
+
+        if establish_cache is not None:
+            (p_factor,) = establish_cache.lookup(
+                trips["o_port_id"].to_numpy(), trips["d_port_id"].to_numpy()
+            )
+        else:
+            p_factor = self.nis.establish_factor_trips(trips, port_parser)
+        # ballast risk of an untreated trip (treatment factor 1)
+        p_untreated, p_biofouling = self.nis.combine_batch(
+            p_factor,
+            self.nis.ballast_intro_batch(
+                trips["ballast_discharge"].to_numpy(),
+                trips["voyage_duration"].to_numpy(),
+                treatment=1.0,
+            ),
+            self.nis.biofouling_batch(
+                trips["o_port_lat"].to_numpy(),
+                trips["antifouling_factor"].to_numpy(),
+                trips["spd"].to_numpy(),
+                trips["stay_duration"].to_numpy(),
+            ),
+        )
+        self._p_untreated = p_untreated
+        self.baseline_treatment = np.full(len(trips), float(self.nis.treatment))
+        self.baseline_ballast = p_untreated * self.baseline_treatment
+        self.biofouling = p_biofouling
+        self._baseline_log_ballast = self._group_log_survival(self.baseline_ballast)
+        self._log_biofouling = self._group_log_survival(p_biofouling)
+
+    def _group_log_survival(
+        self, risk: np.ndarray, trips: tp.Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        # sum of log(1 - risk) per group, trips without a risk count as 0
+        codes = self._group_codes if trips is None else self._group_codes[trips]
+        survival = log_survival(risk)
+        known = codes >= 0
+        return np.bincount(
+            codes[known], weights=survival[known], minlength=len(self.groups)
+        )
+
+    def treatment_factors(
+        self, rules: tp.Sequence[TreatmentRule]
+    ) -> tp.Tuple[np.ndarray, np.ndarray]:
+        # per-trip treatment factor (1 - efficacy) and the trips some rule matched
+        # a trip matched by several rules takes the last one
+        factors = self.baseline_treatment.copy()
+        matched = np.zeros(len(factors), dtype=bool)
+        for rule in rules:
+            rule_match = rule.match(self.trips)
+            factors[rule_match] = 1.0 - rule.efficacy
+            matched |= rule_match
+        return factors, matched
+
+    def ballast_risk(self, rules: tp.Sequence[TreatmentRule]) -> np.ndarray:
+        # per-trip ballast risk under a scenario
+        factors, _ = self.treatment_factors(rules)
+        return self._p_untreated * factors
+
+    def evaluate(self, rules: tp.Sequence[TreatmentRule]) -> pd.DataFrame:
+        # aggregate ballast / biofouling risk per group under a scenario
+        # only the matched trips are re-scored, on top of the baseline aggregates
+        factors, matched = self.treatment_factors(rules)
+        trips = np.flatnonzero(matched & (factors != self.baseline_treatment))
+        log_ballast = self._baseline_log_ballast + self._group_log_survival(
+            self._p_untreated[trips] * factors[trips], trips
+        ) - self._group_log_survival(self.baseline_ballast[trips], trips)
+        return pd.DataFrame(
+            {
+                "ballast_risk": risk_from_log_survival(log_ballast),
+                "biofouling_risk": risk_from_log_survival(self._log_biofouling),
+            },
+            index=self.groups,
+        )
+
+    def compare(
+        self, scenarios: tp.Dict[str, tp.Sequence[TreatmentRule]]
+    ) -> pd.DataFrame:
+        # aggregate ballast risk per group of the baseline and every scenario
+        comparison = pd.DataFrame(
+            {"baseline": risk_from_log_survival(self._baseline_log_ballast)},
+            index=self.groups,
+        )
+        for name, rules in scenarios.items():
+            comparison[name] = self.evaluate(rules)["ballast_risk"]
+        return comparison
@@ -0,0 +1,167 @@
+# columnar (parquet) store of scored trips
+# TRIP_FILE_COLUMNS typed as TRIP_SCHEMA: int64 / float64 / timestamp columns and
+# dictionary encoded port / country / vessel type columns, hive partitioned by
+# arrival year (year=2015/part-00000-0.parquet). Rows are sorted by destination port
+# in row groups of PARQUET_ROW_GROUP_ROWS, a d_port_ids read skips the row groups
+# whose d_port_id statistics miss it; partitioning by port too would write one small
+# file per port and flush and run into the dataset writer's partition limit
+# pyarrow is only imported when a parquet store is used
+import os
+import typing as tp
+from pathlib import Path
+
+import pandas as pd
+
+from parsers import TRIP_FILE_COLUMNS, TRIP_SCHEMA
+
+if tp.TYPE_CHECKING:
+    import pyarrow as pa
+
+# buffered trips written as one file per year
+PARQUET_FLUSH_ROWS = 1000000
+PARQUET_ROW_GROUP_ROWS = 64 * 1024
+PARTITION_COLUMNS = ["year"]
+
+
+def _arrow_type(tg_type: str) -> "pa.DataType":
+    import pyarrow as pa
+
+    return {
+        "int": pa.int64(),
+        "float": pa.float64(),
+        "category": pa.dictionary(pa.int32(), pa.string()),
+        "str": pa.string(),
+        "datetime": pa.timestamp("us"),
+    }[tg_type]
+
+
+def trip_arrow_schema() -> "pa.Schema":
+    import pyarrow as pa
+
+    return pa.schema(
+        [pa.field(column, _arrow_type(TRIP_SCHEMA[column])) for column in TRIP_FILE_COLUMNS]
+    )
+
+
+def _partitioning():
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    return ds.partitioning(pa.schema([("year", pa.int32())]), flavor="hive")
+
+
+def trips_to_arrow(trips: pd.DataFrame) -> "pa.Table":
+    # TRIP_FILE_COLUMNS of a scored trip table with the year partition column
+    import pyarrow as pa
+
+    arrays = []
+    for column in TRIP_FILE_COLUMNS:
+        values = trips[column]
+        tg_type = TRIP_SCHEMA[column]
+        if tg_type == "category":
+            array = pa.array(
+                values.astype(object), type=pa.string(), from_pandas=True
+            ).dictionary_encode()
+        elif tg_type == "int":
+            array = pa.array(pd.array(values, dtype="Int64"), type=pa.int64())
+        elif tg_type == "datetime":
+            array = pa.array(pd.to_datetime(values), type=pa.timestamp("us"), from_pandas=True)
+        else:
+            array = pa.array(values, type=_arrow_type(tg_type), from_pandas=True)
+        arrays.append(array)
+    year = pd.to_datetime(trips["arrival_date"]).dt.year
+    arrays.append(pa.array(year, type=pa.int32(), from_pandas=True))
+    return pa.Table.from_arrays(arrays, schema=trip_arrow_schema().append(pa.field("year", pa.int32())))
+
+
+class ParquetTripWriter:
+    # trips are buffered and written by flush(); every flush is one numbered part
+    # (part-<part>-*.parquet in each year), truncate() drops the parts after a point
+    def __init__(self, dataset_dir: str, flush_rows: int = PARQUET_FLUSH_ROWS) -> None:
+        self.dataset_dir = Path(dataset_dir)
+        self.flush_rows = flush_rows
+        self.parts = 0
+        self._buffer: tp.List["pa.Table"] = []
+        self._rows = 0
+
+    @property
+    def buffered_rows(self) -> int:
+        # trips written since the last flush
+        return self._rows
+
+    def write(self, trips: pd.DataFrame) -> None:
+        if len(trips) == 0:
+            return
+        self._buffer.append(trips_to_arrow(trips))
+        self._rows += len(trips)
+        if self._rows >= self.flush_rows:
+            self.flush()
+
+    def flush(self) -> int:
+        # write the buffer to disk (fsynced), return the number of parts
+        if self._buffer:
+            import pyarrow as pa
+            import pyarrow.dataset as ds
+
+            written = []
+            trips = pa.concat_tables(self._buffer).sort_by(
+                [(column, "ascending") for column in PARTITION_COLUMNS + ["d_port_id"]]
+            )
+            years = max(len(trips.column("year").unique()), 1)
+            ds.write_dataset(
+                trips,
+                self.dataset_dir,
+                format="parquet",
+                partitioning=_partitioning(),
+                basename_template=f"part-{self.parts:05d}-{{i}}.parquet",
+                existing_data_behavior="overwrite_or_ignore",
+                preserve_order=True,
+                max_partitions=max(years, 1024),
+                max_open_files=max(years, 1024),
+                max_rows_per_group=PARQUET_ROW_GROUP_ROWS,
+                file_visitor=lambda written_file: written.append(written_file.path),
+            )
+            for path in written:
+                with open(path, "rb") as f:
+                    os.fsync(f.fileno())
+            self.parts += 1
+            self._buffer = []
+            self._rows = 0
+        return self.parts
+
+    def truncate(self, parts: int = 0) -> None:
+        # drop the parts numbered parts and above (0: every part) and the buffer
+        self._buffer = []
+        self._rows = 0
+        self.parts = parts
+        if not self.dataset_dir.exists():
+            return
+        for path in self.dataset_dir.rglob("part-*.parquet"):
+            if int(path.name.split("-")[1]) >= parts:
+                path.unlink()
+
+
+def read_trip_parquet(
+    dataset_dir: str,
+    columns: tp.Optional[tp.Sequence[str]] = None,
+    years: tp.Optional[tp.Sequence[int]] = None,
+    d_port_ids: tp.Optional[tp.Sequence[int]] = None,
+) -> pd.DataFrame:
+    # trip table of a ParquetTripWriter store, typed as read_pipe_file(TRIP_SCHEMA)
+    # only the given columns of the given years / destination ports are read
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(dataset_dir, format="parquet", partitioning=_partitioning())
+    expression = None
+    for column, values in [("year", years), ("d_port_id", d_port_ids)]:
+        if values is not None:
+            condition = ds.field(column).isin(list(values))
+            expression = condition if expression is None else expression & condition
+    columns = list(columns) if columns is not None else TRIP_FILE_COLUMNS
+    trips = dataset.to_table(columns=columns, filter=expression).to_pandas()
+    for column in columns:
+        if TRIP_SCHEMA.get(column) == "int":
+            trips[column] = trips[column].astype("Int64")
+        elif TRIP_SCHEMA.get(column) == "category":
+            trips[column] = trips[column].astype("category")
+    return trips